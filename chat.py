@@ -1,15 +1,20 @@
-from functools import partial, lru_cache
-from queue import Queue, Full
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
 from random import choice
-from threading import Thread
-from itertools import groupby, cycle
-from json import loads
+from threading import Event, Lock, Thread
+from itertools import groupby
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from time import time, sleep
 import logging
+import multiprocessing
+import os
 
 from PIL import Image, ImageFont, ImageDraw, ImageTk
 
 import downloader
+import images
+import store
 
 try:
     FONT = ImageFont.truetype("tahomabd.ttf", 12)
@@ -34,14 +39,82 @@ DEFAULT_COLORS = [
     "#B22222", # Firebrick
 ]
 
-background_colors = cycle(("#1f1925", "#19171c"))
+# Alternates by message index so a block looks the same whenever it's rendered
+BACKGROUND_COLORS = ("#1f1925", "#19171c")
 PADX, PADY = 5, 5
 LINE_HEIGHT = 25
+CHAT_HEIGHT = 2000
 chat_width = 340
 
-textsize = lru_cache(maxsize=None)(
-    partial(ImageDraw.Draw(Image.new("RGB", (0, 0))).textsize, font=FONT)
-)
+# Seconds of chat rendered ahead of the video
+LOOKAHEAD = 10
+# Seconds of chat after the resume point that emotes are decoded for before they're needed
+PREWARM_SECONDS = 600
+# Memory the rendered message blocks can use
+BLOCK_CACHE_SIZE = 32 * 2**20
+# After a seek the player can report the time from before it for a moment, timestamps
+# further than SEEK_TOLERANCE seconds from the target are ignored for up to SEEK_TIMEOUT seconds
+SEEK_TOLERANCE = 1
+SEEK_TIMEOUT = 2
+
+class Metrics():
+    """
+    Measures text from the advance of each glyph and the kerning of each pair of glyphs.
+    Each glyph and pair is only measured by the font once,
+    so nothing is kept per string no matter how many different words the chat has.
+    """
+    
+    def __init__(self, font):
+        self.font = font
+        self.advances = {}
+        self.kerning = {}
+        
+        # Same height for every string so all text in a line shares a baseline
+        self.height = font.getsize("Ag")[1]
+    
+    def advance(self, char):
+        if char not in self.advances:
+            self.advances[char] = self.font.getlength(char)
+        
+        return self.advances[char]
+    
+    def kern(self, pair):
+        if pair not in self.kerning:
+            self.kerning[pair] = self.font.getlength(pair) - self.advance(pair[0]) - self.advance(pair[1])
+        
+        return self.kerning[pair]
+    
+    def widths(self, text):
+        """Returns the width of every prefix of text, widths[i] is the width of text[:i+1]."""
+        
+        widths = []
+        width = 0
+        previous = None
+        
+        for char in text:
+            width += self.advance(char)
+            if previous is not None:
+                width += self.kern(previous + char)
+            previous = char
+            widths.append(round(width))
+        
+        return widths
+    
+    def width(self, text):
+        widths = self.widths(text)
+        return widths[-1] if widths else 0
+    
+    def split(self, text, max_width):
+        """Splits off the longest start of text that fits in max_width."""
+        
+        # At least one character so a single glyph wider than max_width can't loop forever
+        i = max(1, bisect_right(self.widths(text), max_width))
+        return text[:i], text[i:]
+
+METRICS = Metrics(FONT)
+
+def textsize(text):
+    return METRICS.width(text), METRICS.height
 
 @lru_cache(maxsize=None)
 def name_cache(name, color=None):
@@ -50,198 +123,408 @@ def name_cache(name, color=None):
     
     return image
 
-@lru_cache(maxsize=None)
-def twitch_emote(emote_id):
-    return Image.open(f"twitch_emotes/{emote_id}.png").convert("RGBA")
+# Worker processes for prewarm, started on first use and shared by every Chat
+decode_pool = None
+decode_pool_lock = Lock()
+
+def get_decode_pool():
+    global decode_pool
+    
+    with decode_pool_lock:
+        if decode_pool is None:
+            # Spawned rather than forked on every platform, forking copies this process's threads' locks.
+            # The workers only run images.decode, downloader.init() isn't called in them.
+            context = multiprocessing.get_context("spawn")
+            decode_pool = ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1), mp_context=context)
+        
+        return decode_pool
 
 class BadgeCache(downloader.BadgeCache):
-    @lru_cache(maxsize=None)
-    def __getitem__(self, code):
-        image = Image.new("RGBA", (20, 21))
-        badge = Image.open(f"badges/{self.emotes[code]}").convert("RGBA")
-        image.paste(badge, (0, 0), badge)
+    def load(self, code):
+        return images.pad_badge(Image.open(downloader.pack.open(f"badges/{self.emotes[code]}")))
+
+Block = namedtuple("Block", "image gifs")
+
+class BlockCache():
+    """LRU cache of rendered message blocks limited to `max_size` bytes."""
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.blocks = OrderedDict()
+        self.lock = Lock()
+    
+    def get(self, key):
+        with self.lock:
+            if key in self.blocks:
+                self.blocks.move_to_end(key)
+                return self.blocks[key]
+    
+    def put(self, key, block):
+        with self.lock:
+            if key in self.blocks:
+                return
+            
+            self.blocks[key] = block
+            self.size += block.image.width * block.image.height * 3
             
-        return image
+            while self.size > self.max_size and len(self.blocks) > 1:
+                _, old = self.blocks.popitem(last=False)
+                self.size -= old.image.width * old.image.height * 3
 
 class Chat(Thread):
     """Class for drawing the chat."""
     def __init__(self, video, canvas):
         super().__init__(daemon=True)
         
-        with open(f"Files/{video['id']}/chat.txt") as fp:
-            self.data = [loads(line.rstrip("\n")) for line in fp]
+        filename = f"Files/{video['id']}/chat.bin"
+        if not os.path.exists(filename):
+            logging.info(f"Converting chat: {video['id']}")
+            table = downloader.EmoteTable(video, download=False)
+            store.convert(f"Files/{video['id']}/chat.txt", filename, table.tokenize_message, table.files)
+        self.data = store.ChatStore(filename)
+        
+        # Frames are drawn by this thread into one buffer while the Tk thread
+        # can still be copying the other one into the PhotoImage.
+        self.lock = Lock()
+        self.buffers = [Image.new("RGBA", (chat_width, CHAT_HEIGHT)) for _ in range(2)]
+        self.latest = 0
+        self.dirty = False
+        self.running = True
+        
+        self.blocks = BlockCache(BLOCK_CACHE_SIZE)
+        self.lookahead = Event()
+        self.timestamp = 0
         
         self.canvas = canvas
-        self.seek(0)
+        self.photo = ImageTk.PhotoImage("RGBA", (chat_width, CHAT_HEIGHT))
+        self.canvas.set_image(self.photo)
+        self.reset(0)
+        
+        # Seeks come from the Tk thread and are applied by this thread at the start of draw
+        self.pending = None
+        self.target = None
+        self.seek_time = 0
         
-        self.queue = Queue(maxsize=1)
+        # Only the newest timestamp matters, draw catches up on every message before it
+        self.update = Event()
         
         self.badge_cache = BadgeCache(video)
-        self.bttv_cache = downloader.BttvCache(video)
-        self.ffz_cache = downloader.FfzCache(video)
-        self._7tv_cache = downloader._7tvCache(video)
         
+        Thread(target=self.prewarm, args=(video["played"],), daemon=True).start()
         self.start()
+        Thread(target=self.prerender, daemon=True).start()
+        self.canvas.after(20, self.present)
         
         logging.info(f"Chat start: {video['id']}")
         
     def __call__(self, timestamp):
-        try:
-            self.queue.put_nowait(timestamp)
-        except Full:
-            pass
+        if self.target is not None:
+            # draw catches up on every message due, one stale timestamp would undo a backward seek
+            if abs(timestamp - self.target) > SEEK_TOLERANCE and time() < self.seek_time + SEEK_TIMEOUT:
+                return
+            self.target = None
+        
+        self.timestamp = timestamp
+        self.lookahead.set()
+        self.update.set()
+    
+    def stop(self):
+        self.running = False
+        self.update.set()
+        
+        downloader.assets.log_stats()
     
     def run(self):
-        while True:
-            self.canvas.set_image(ImageTk.PhotoImage(self.draw(self.queue.get())))
+        while self.running:
+            self.update.wait()
+            self.update.clear()
+            
+            if self.draw(self.timestamp):
+                # The oldest row is at the head so the frame is the rows
+                # from the head to the bottom followed by the rows above the head.
+                frame = self.buffers[1 - self.latest]
+                frame.paste(self.base, (0, -self.head))
+                frame.paste(self.base, (0, CHAT_HEIGHT - self.head))
+                
+                with self.lock:
+                    self.latest = 1 - self.latest
+                    self.dirty = True
             sleep(.02)
+    
+    def present(self):
+        # Runs on the Tk thread, only updates the PhotoImage when there is a new frame.
+        
+        if not self.running:
+            return
+        
+        with self.lock:
+            if self.dirty:
+                self.photo.paste(self.buffers[self.latest])
+                self.dirty = False
+        
+        self.canvas.after(20, self.present)
             
     def seek(self, timestamp):
+        with self.lock:
+            self.pending = timestamp
+        
+        self.target = timestamp
+        self.seek_time = time()
+        self.timestamp = timestamp
+        self.lookahead.set()
+        self.update.set()
+    
+    def reset(self, timestamp):
         # Clear the current frame
-        self.base = Image.new("RGBA", (chat_width, 2000), "#33393b")
+        # self.base is a ring buffer, rows are written at self.head which wraps around
+        # to the top, so scrolling never has to move the rows already drawn.
+        self.base = Image.new("RGBA", (chat_width, CHAT_HEIGHT), "#33393b")
+        self.changed = True
+        self.head = 0
+        self.scrolled = 0
         self.gifs = []
-        self.counter = 0
         
         # Loads up to 30 messages before timestamp
-        while self.data[self.counter]["offset"] < timestamp:
-            self.counter += 1
-        self.counter -= 30
-        self.current = self.data[self.counter]
+        self.counter = max(0, bisect_left(self.data.offsets, timestamp) - 30)
     
-    def draw(self, timestamp):
-        if timestamp >= self.current["offset"]:
-            # Draw badges
-            message = [[
-                self.badge_cache[f'{data["_id"]}/{data["version"]}']
-                for data in self.current.get("badges", ())
-            ]]
-            
-            # Draw name
-            message[-1].append(name_cache(self.current["name"], self.current["color"]))
-            line_width = sum(item.width for item in message[-1]) + textsize(": ")[0] + PADX*2
-            message[-1].append(": ")
-            
-            def update(image, width=None):
-                if width is None:
-                    width = image.width
+    def render(self, index):
+        """Lays out and draws the message at `index` into a block."""
+        
+        current = self.data[index]
+            
+        # Draw badges
+        message = [[
+            self.badge_cache[f'{data["_id"]}/{data["version"]}']
+            for data in current.get("badges", ())
+        ]]
+            
+        # Draw name
+        message[-1].append(name_cache(current["name"], current["color"]))
+        line_width = sum(item.width for item in message[-1]) + textsize(": ")[0] + PADX*2
+        message[-1].append(": ")
+            
+        def update(image, width=None):
+            if width is None:
+                width = image.width
                 
-                nonlocal line_width
+            nonlocal line_width
                 
-                if line_width + width > chat_width:
-                    message.append([])
-                    line_width = PADX * 2
+            if line_width + width > chat_width:
+                message.append([])
+                line_width = PADX * 2
                     
-                message[-1].append(image)
-                line_width += width
+            message[-1].append(image)
+            line_width += width
+            
+        for token in current["tokens"]:
+            if isinstance(token, int):
+                filename = self.data.emotes[token]
+                try:
+                    update(downloader.assets.get(filename, lambda: downloader.load_image(filename)))
+                except FileNotFoundError:
+                    logging.error(f"Emote not found: {filename}")
+                continue
+                        
+            # Split long words over chat_width pixels wide
+            word = token
+            while METRICS.width(word) > chat_width:
+                left, word = METRICS.split(word, chat_width)
+                update(left, METRICS.width(left))
+                        
+            update(word, METRICS.width(word))
             
-            for fragment in self.current["fragments"]:
-                if isinstance(fragment, str):
-                    c = fragment
+        ######################### Draw message
+            
+        background = BACKGROUND_COLORS[index % 2]
+            
+        block = Image.new(
+            "RGB",
+            (chat_width, PADY*2 + LINE_HEIGHT*len(message)),
+            background
+        )
+        img_draw = ImageDraw.Draw(block)
+            
+        gifs = []
+            
+        for row_index, row in enumerate(message):
+            x = PADX
+            for item in row:
+                n = PADY + LINE_HEIGHT*row_index
+                if isinstance(item, str):
+                    width, height = textsize(item)
+                    img_draw.text(
+                        (x, n + (LINE_HEIGHT - height)//2),
+                        item,
+                        fill="#dad8da",
+                        font=FONT    
+                    )
+                    x += width
+                elif isinstance(item, downloader.Gif):
+                    gifs.append((item, background, x, n + (LINE_HEIGHT - item.height)//2))
+                    x += item.width
                 else:
-                    if fragment.get("emoticon"):
-                        try:
-                            try:
-                                update(twitch_emote(fragment["emoticon"]))
-                            except FileNotFoundError:
-                                logging.error(f"Emote not found: {fragment['emoticon']}")
-                                downloader.twitch_emote(fragment["emoticon"])
-                                update(twitch_emote(fragment["emoticon"]))
-                            continue
-                        except downloader.requests.exceptions.ConnectionError:
-                            logging.error(f"Connection Error")
-                    
-                    c = fragment["text"]
+                    block.paste(
+                        item,
+                        (x, n - item.height//2 + 12),
+                        item
+                    )
+                    x += item.width
+            
+        return Block(block, gifs)
+    
+    def block(self, index):
+        block = self.blocks.get(index)
+        
+        if block is None:
+            block = self.render(index)
+            self.blocks.put(index, block)
+        
+        return block
+    
+    def prewarm(self, timestamp):
+        """
+        Decodes the emotes and badges used around `timestamp` in a process pool
+        so they're already in downloader.assets when their first message is drawn.
+        The ones used in the first minute go first, each group most used first.
+        """
+        
+        start = max(0, bisect_left(self.data.offsets, timestamp) - 30)
+        end = bisect_right(self.data.offsets, timestamp + PREWARM_SECONDS)
+        
+        counts = Counter()
+        near = set()
+        
+        for index in range(start, end):
+            message = self.data[index]
+            
+            files = [self.data.emotes[token] for token in message["tokens"] if isinstance(token, int)]
+            for data in message["badges"]:
+                code = f'{data["_id"]}/{data["version"]}'
+                if code in self.badge_cache:
+                    files.append(f"badges/{self.badge_cache.emotes[code]}")
+            
+            counts.update(files)
+            if message["offset"] <= timestamp + 60:
+                near.update(files)
+        
+        files = [
+            filename for filename in sorted(counts, key=lambda filename: (filename not in near, -counts[filename]))
+            if filename not in downloader.assets and filename in downloader.pack
+        ]
+        
+        if not files:
+            return
+        
+        logging.info(f"Prewarm: decoding {len(files)} images")
+        
+        pool = get_decode_pool()
+        futures = [
+            pool.submit(images.decode, filename, downloader.pack.read(filename), filename.startswith("badges/"))
+            for filename in files
+        ]
+            
+        for future in as_completed(futures):
+            if not self.running:
+                # Frees the shared pool for the next Chat
+                for future in futures:
+                    future.cancel()
+                break
                 
-                while c:
-                    # Using partition instead of split because I want to keep the spaces
-                    a, b, c = c.partition(" ")
-                    for word in (a, b):
-                        if word == "":
-                            continue
-                        
-                        for emote_cache in (self.bttv_cache, self.ffz_cache, self._7tv_cache):
-                            if word in emote_cache:
-                                update(emote_cache[word])
-                                break
-                        else:
-                            while True:
-                                width = textsize(word)[0]
-                                if width > chat_width:
-                                    # Split long words over chat_width pixels wide
-                                    for i in range(len(word)):
-                                        width = textsize(word[:i+1])[0]
-                                        if width > chat_width:
-                                            left, word = word[:i], word[i:]
-                                            update(left, textsize(left)[0])
-                                            break
-                                else:
-                                    update(word, width)
-                                    break
-            
-            ######################### Draw message
-            
-            background = next(background_colors)
-            
-            block = Image.new(
-                "RGB",
-                (chat_width, PADY*2 + LINE_HEIGHT*len(message)),
-                background
-            )
-            img_draw = ImageDraw.Draw(block)
-            
-            self.gifs = [(*_, y + block.height) for *_, y in self.gifs if y < 2000]
-            
-            for row_index, row in enumerate(message):
-                x = PADX
-                for item in row:
-                    n = PADY + LINE_HEIGHT*row_index
-                    if isinstance(item, str):
-                        width, height = textsize(item)
-                        img_draw.text(
-                            (x, n + (LINE_HEIGHT - height)//2),
-                            item,
-                            fill="#dad8da",
-                            font=FONT    
-                        )
-                        x += width
-                    elif isinstance(item, downloader.Gif):
-                        self.gifs.append((
-                            item,
-                            background,
-                            x,
-                            block.height - n - (LINE_HEIGHT - item.height)//2
-                        ))
-                        x += item.width
-                    else:
-                        block.paste(
-                            item,
-                            (x, n - item.height//2 + 12),
-                            item
-                        )
-                        x += item.width
-            
-            # Moves the base image up by the height of the current block
-            self.base = self.base.transform(
-                (self.base.size[0], 2000),
-                Image.AFFINE,
-                # Copied online, not sure how this corresponds to the transformation
-                (1, 0, 0, 0, 1, block.height)
-            )
-            self.base.paste(block, (0, self.base.height - block.height))
-            
-            self.counter += 1
-            if self.counter < len(self.data):
-                self.current = self.data[self.counter]
-            else:
-                self.current = {"offset": float("inf")}
-            
-        for gif, background, x, y in self.gifs:
-            # Draws Gifs by covering up the old frame of the gif,
-            # then pasting the new frame on top.
-            
-            image = gif[time()]
-            cover = Image.new("RGB", image.size, background)
-            self.base.paste(cover, (x, self.base.height - y))
-            self.base.paste(image, (x, self.base.height - y), image)
-        
-        return self.base
\ No newline at end of file
+            try:
+                filename, decoded = future.result()
+            except Exception as e:
+                logging.error(f"Prewarm: {e!r}")
+                continue
+                
+            downloader.assets.put(filename, downloader.restore_image(decoded))
+        
+        downloader.assets.log_stats()
+    
+    def prerender(self):
+        # Renders the messages in the next LOOKAHEAD seconds in the background
+        # so draw only has to paste finished blocks.
+        
+        while self.running:
+            self.lookahead.wait(1)
+            self.lookahead.clear()
+            
+            index = self.counter
+            end = self.timestamp + LOOKAHEAD
+            
+            while self.running and index < len(self.data) and self.data.offset(index) <= end:
+                self.block(index)
+                index += 1
+    
+    def draw(self, timestamp):
+        """Draws any new message and gif frames into self.base, returns whether anything changed."""
+        
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if pending is not None:
+            self.reset(pending)
+            timestamp = pending
+        
+        changed, self.changed = self.changed, False
+        
+        # Every message due by `timestamp` is drawn in this pass.
+        # Only the newest CHAT_HEIGHT rows can be seen so older blocks aren't rendered at all.
+        end = self.counter
+        while end < len(self.data) and self.data.offset(end) <= timestamp:
+            end += 1
+        
+        blocks = []
+        height = 0
+        for index in range(end - 1, self.counter - 1, -1):
+            if height >= CHAT_HEIGHT:
+                break
+            
+            block = self.block(index)
+            blocks.append(block)
+            height += block.image.height
+        
+        if blocks:
+            changed = True
+            
+            # Gif positions are rows since the last seek
+            self.gifs = [gif for gif in self.gifs if gif[3] > self.scrolled + height - CHAT_HEIGHT]
+            
+            for block in reversed(blocks):
+                for gif, background, x, y in block.gifs:
+                    self.gifs.append([gif, background, x, self.scrolled + y, None])
+            
+                # Overwrites the oldest rows with the block
+                self.paste(block.image, 0, self.scrolled)
+                self.scrolled += block.image.height
+            
+            self.head = self.scrolled % CHAT_HEIGHT
+            self.counter = end
+            
+            # Gifs that were drawn and then scrolled out of view by a later block in this pass
+            self.gifs = [gif for gif in self.gifs if gif[3] > self.scrolled - CHAT_HEIGHT]
+            
+        now = time()
+        for entry in self.gifs:
+            # Draws Gifs by pasting the frame already drawn over the background,
+            # which covers up the old frame of the gif.
+            
+            gif, background, x, y, last = entry
+            index = gif.index(now)
+            if index == last:
+                continue
+            
+            entry[-1] = index
+            changed = True
+            
+            self.paste(gif.composite(index, background), x, y)
+        
+        return changed
+    
+    def paste(self, image, x, row, mask=None):
+        """Pastes the image at `row` rows since the last seek, wrapping around the ring buffer."""
+        
+        y = row % CHAT_HEIGHT
+        self.base.paste(image, (x, y), mask)
+        
+        if y + image.height > CHAT_HEIGHT:
+            self.base.paste(image, (x, y - CHAT_HEIGHT), mask)
\ No newline at end of file
@@ -1,15 +1,23 @@
-from functools import lru_cache
+from concurrent.futures import TimeoutError, wait
+from collections import OrderedDict
+from io import BytesIO
 from queue import Queue
-from threading import Thread
+from threading import Condition, Lock, RLock, Thread
+import asyncio
+import hashlib
 import json
 import logging
 import os
-import requests
+import re
 import time
 import shutil
 
 from PIL import Image
 
+import images
+import network
+import store
+
 logging.basicConfig(
     style="{",
     level=logging.INFO,
@@ -17,8 +25,11 @@ logging.basicConfig(
     datefmt='%H:%M:%S'
 )
 
-for folder in ("Files", "twitch_emotes", "badges", "bttv_emotes", "ffz_emotes", "7tv_emotes"):
-    os.makedirs(folder, exist_ok=True)
+ASSET_FOLDERS = ("twitch_emotes", "badges", "bttv_emotes", "ffz_emotes", "7tv_emotes")
+
+# Importing this module doesn't touch any file or start any thread, so the chat's
+# worker processes can import it. init() opens these and starts the network loop.
+info = pack = library = scheduler = None
 
 def format_time(seconds):
     hours, seconds = divmod(seconds, 3600)
@@ -46,228 +57,1022 @@ class Info(dict):
         with open("info.json", "w") as fp:
             json.dump(self, fp, indent=4, sort_keys=True)
 
-info = Info()
-session = requests.Session()
-thread_queue = Queue()
+CHUNK_SIZE = 64 * 1024
 
-def http_thread():
-    cache = {}
+class Bandwidth():
+    """
+    Token bucket shared by all downloader traffic.
     
-    while True:
-        items = thread_queue.get()
+    `rate` is the limit in bytes per second, 0 means unlimited.
+    `burst` is how many bytes can be used at once after being idle,
+    defaults to one second worth of traffic.
+    Waiting coroutines check the bucket again at least every 100 ms,
+    so a new rate takes effect within one of those checks.
+    """
+    
+    def __init__(self, rate=0, burst=None):
+        self.lock = Lock()
+        self.tokens = 0
+        self.set_rate(rate, burst)
+    
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = max(0, rate)
+            self.burst = burst or max(self.rate, CHUNK_SIZE)
+            self.tokens = min(self.tokens, self.burst)
+            self.time = time.monotonic()
+    
+    def take(self, amount):
+        """Takes `amount` bytes and returns 0, or returns how long to wait before trying again."""
         
-        logging.info(f"http_thread: {items}")
+        if not self.rate:
+            return 0
         
-        callback, _type, values = items
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+                
+        # Reads larger than the burst are allowed to go into debt,
+        # otherwise they would never get through.
+        needed = min(amount, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= amount
+            return 0
         
-        if items in cache and time.time() - cache[items]["time"] < 30 * 60:
-            logging.info(f"http_thread cache: {items}")
-            callback(cache[items]["output"])
-            continue
+        return (needed - self.tokens) / self.rate
+    
+    async def consume(self, amount):
+        """Sleeps until `amount` bytes are allowed through, without blocking the event loop."""
         
-        if _type == "video":
-            values = dict(values)
+        while True:
+            with self.lock:
+                delay = self.take(amount)
             
-            video = VideoData(values["id"])
-            video.update(values)
-            video.save()
+            if not delay:
+                return
             
-            cache[items] = {
-                "time": time.time(),
-                "output": video
-            }
+            await asyncio.sleep(min(delay, .1))
+
+bandwidth = Bandwidth()
+net = network.Network()
+
+class Gql():
+    """
+    Sends GQL operations in batches.
+    GQL takes a list of operations in one POST, so operations posted within `window`
+    seconds of each other are sent together, at most `max_batch` at a time,
+    and each caller gets the responses to its own operations back.
+    Only used on the network loop.
+    """
+    
+    URL = "https://gql.twitch.tv/gql"
+    
+    def __init__(self, window=0.05, max_batch=30):
+        self.window = window
+        self.max_batch = max_batch
+        self.batch = []
+        self.size = 0
+        self.timer = None
+        # The loop only keeps weak references to tasks, these are kept until they finish
+        self.tasks = set()
+    
+    async def post(self, operations):
+        """
+        Returns (status code, data) where data is the list of responses to `operations`,
+        or the whole error response when the batch failed.
+        """
+        
+        if self.size + len(operations) > self.max_batch:
+            self.flush()
+        
+        future = asyncio.get_running_loop().create_future()
+        self.batch.append((operations, future))
+        self.size += len(operations)
+        
+        if self.size >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        
+        return await future
+    
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        
+        batch, self.batch, self.size = self.batch, [], 0
+        if batch:
+            task = asyncio.ensure_future(self.send(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+    
+    async def send(self, batch):
+        operations = [operation for request, _ in batch for operation in request]
+        logging.info(f"GQL: {len(operations)} operations from {len(batch)} requests")
+        
+        try:
+            response = await net.request("POST", self.URL, json=operations)
+            data = response.json()
+        except (*network.ERRORS, ValueError) as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        position = 0
+        for request, future in batch:
+            if response.status_code == 200 and isinstance(data, list):
+                result = data[position:position + len(request)]
+                position += len(request)
+            else:
+                result = data
             
-            callback(video)
-        elif _type == "past_broadcasts":
-            login, cursor = values
-            
-            parameters = [
-                {
-                    "operationName":"FilterableVideoTower_Videos",
-                    "variables": {
-                        "limit":10,
-                        "channelOwnerLogin": login,
-                        "broadcastType":"ARCHIVE",
-                        "cursor": cursor,
-                        "videoSort":"TIME"
-                    },
-                    "extensions": {
-                        "persistedQuery": {
-                            "version":1,
-                            "sha256Hash":"a937f1d22e269e39a03b509f65a7490f9fc247d7f83d6ac1421523e3b68042cb"
-                        }
-                    }
-                }
-            ]
+            # Callers that were cancelled are skipped
+            if not future.done():
+                future.set_result((response.status_code, result))
+
+gql = Gql()
+
+class ResponseCache():
+    """
+    Response bodies of http() requests, keyed on the request type and values only.
+    Bodies expire after `ttl` seconds and the least recently used are dropped
+    once they take more than `max_size` bytes.
+    """
+    
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.hits = self.misses = 0
+        self.responses = OrderedDict()
+        self.lock = Lock()
+    
+    def get(self, key):
+        """Returns the body saved for `key` or None."""
+        
+        with self.lock:
+            if key in self.responses:
+                saved, body = self.responses[key]
+                
+                if time.time() - saved < self.ttl:
+                    self.hits += 1
+                    self.responses.move_to_end(key)
+                    return body
+                
+                del self.responses[key]
+                self.size -= len(body)
             
-            response = session.post("https://gql.twitch.tv/gql", json=parameters)
-            if response.status_code == 200:            
-                cache[items] = {
-                    "time": time.time(),
-                    "output": response
+            self.misses += 1
+    
+    def put(self, key, body):
+        with self.lock:
+            if key in self.responses:
+                self.size -= len(self.responses.pop(key)[1])
+            
+            self.responses[key] = time.time(), body
+            self.size += len(body)
+            
+            while self.size > self.max_size and len(self.responses) > 1:
+                _, (_, old) = self.responses.popitem(last=False)
+                self.size -= len(old)
+    
+    def log_stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0
+        logging.info(f"Response cache: {len(self.responses)} responses / {self.size} bytes | {self.hits} hits / {self.misses} misses ({ratio:.2%})")
+
+responses = ResponseCache(4 * 2**20, 30 * 60)
+
+# Requests go through lanes, each with its own limit of requests running at once,
+# so a slow request in one lane (a video's playlists) doesn't hold up another (the browse page).
+# Metadata and prefetch requests mostly wait on gql, more of them means bigger batches.
+LANES = {
+    "browse": 2,
+    "metadata": 6,
+    "prefetch": 8
+}
+LANE_TYPES = {
+    "past_broadcasts": "browse",
+    "video": "metadata"
+}
+# asyncio.Semaphore of each lane, made on the loop
+lanes = {}
+
+# Requests that are waiting or being fetched, by (type, values).
+# A request that's already waiting isn't fetched again, the callback is added to it.
+waiting = {}
+waiting_lock = Lock()
+# Finished requests as (request, output), their callbacks are called by drain()
+finished = []
+
+async def past_broadcasts(login, cursor):
+    """Returns the body of the streamer's video list, or an error message."""
+            
+    parameters = [
+        {
+            "operationName":"FilterableVideoTower_Videos",
+            "variables": {
+                "limit":10,
+                "channelOwnerLogin": login,
+                "broadcastType":"ARCHIVE",
+                "cursor": cursor,
+                "videoSort":"TIME"
+            },
+            "extensions": {
+                "persistedQuery": {
+                    "version":1,
+                    "sha256Hash":"a937f1d22e269e39a03b509f65a7490f9fc247d7f83d6ac1421523e3b68042cb"
                 }
+            }
+        }
+    ]
+            
+    status_code, data = await gql.post(parameters)
+    if status_code == 200:
+        return json.dumps(data).encode()
+    elif status_code == 400:
+        if data["message"] == 'The \"Client-ID\" header is missing from the request.':
+            logging.error("valid Client ID required")
+            return "Valid Client ID required"
+
+async def http_request(key, request, lane):
+    if lane not in lanes:
+        lanes[lane] = asyncio.Semaphore(LANES[lane])
+    
+    async with lanes[lane]:
+        with waiting_lock:
+            # Cancelled, or already fetched in another lane
+            if waiting.get(key) is not request or request["running"]:
+                return
+            request["running"] = True
+        
+        _type, values = key
+        logging.info(f"http {lane}: {key}")
+        
+        output = None
+        try:
+            if _type == "video":
+                values = dict(values)
                 
-                callback(response)
-            elif response.status_code == 400:
-                if response.json()["message"] == 'The \"Client-ID\" header is missing from the request.':
-                    logging.error("valid Client ID required")
-                    callback("Valid Client ID required")
-        elif _type == "preview":
-            response = session.get(values)
-            
-            if response.status_code == 200:
-                cache[items] = {
-                    "time": time.time(),
-                    "output": response
-                }
-                callback(200, values, response.content)
-            elif response.status_code == 400:
-                if response.json()["message"] == 'The \"Client-ID\" header is missing from the request.':
-                    logging.error("valid Client ID required")
-            else:
-                cache[items] = {
-                    "time": time.time(),
-                    "output": response
-                }
-                callback(response.status_code, values)
+                metadata = None
+                if not os.path.exists(f"Files/{values['id']}/data.txt"):
+                    metadata = await video_metadata(values["id"])
+                
+                # Reads and writes the video's files and the library, kept off the loop
+                output = await asyncio.get_running_loop().run_in_executor(None, save_video, values, metadata)
+            elif _type == "past_broadcasts":
+                body = responses.get(key)
+                
+                if body is None:
+                    body = await past_broadcasts(*values)
+                    if isinstance(body, bytes):
+                        responses.put(key, body)
+                else:
+                    logging.info(f"http cache: {key}")
+                
+                responses.log_stats()
+                output = json.loads(body) if isinstance(body, bytes) else body
+        except (*network.ERRORS, ValueError) as e:
+            logging.error(f"http error: {e!r} | {key}")
+        except Exception:
+            logging.exception(f"http error | {key}")
+        finally:
+            with waiting_lock:
+                if waiting.get(key) is request:
+                    del waiting[key]
+        
+    if output is not None:
+        with waiting_lock:
+            finished.append((request, output))
 
-download_queue = Queue()
-def download_thread():
-    while True:
-        callback, video, speed_var, downloading_var = download_queue.get()
-        logging.info(f"Downloading start | {downloading_var.get()=} / {video['id']=}")
+def save_video(values, metadata):
+    video = VideoData(values["id"], metadata)
+    video.update(values)
+    video.save()
+    
+    return video
+
+def drain():
+    """Calls the callbacks of finished requests, called from the Tk thread."""
+    
+    with waiting_lock:
+        done = finished[:]
+        finished.clear()
+    
+    for request, output in done:
+        for callback, _ in request["callbacks"]:
+            # Runs in Main.tick, an error here would stop it for good
+            try:
+                callback(output)
+            except Exception:
+                logging.exception(f"Callback error | {callback!r}")
+
+async def fetch(url, **kwargs):
+    """net.request for bulk downloads, counted against the bandwidth limit."""
+    
+    response = await net.request("GET", url, **kwargs)
+    await bandwidth.consume(len(response.content))
+    
+    return response
+
+def get(url, **kwargs):
+    """fetch() for threads."""
+    
+    return net.call(fetch(url, **kwargs))
+
+async def download_segment(url, filename):
+    """
+    Runs on the network loop.
+    Streams the segment into `filename`.part, then renames it to `filename`.
+    The rename is atomic so `filename` only ever exists once it is complete.
+    An existing `filename`.part is resumed from where it stopped.
+    """
+    
+    # Continue an interrupted download with a Range request
+    try:
+        offset = os.path.getsize(f"{filename}.part")
+    except FileNotFoundError:
+        offset = 0
+    
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    
+    async with net.stream("GET", url, headers=headers) as response:
+        if response.status == 416:
+            # Nothing after the end of the .part, it's complete if it's as long as the
+            # segment (a crash came before the rename), otherwise it starts over.
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if total != str(offset):
+                os.remove(f"{filename}.part")
+                return await download_segment(url, filename)
+        else:
+            response.raise_for_status()
+    
+            if response.status != 206:
+                # The server ignored the range and sent the whole segment
+                offset = 0
+    
+            with open(f"{filename}.part", "ab" if offset else "wb") as fp:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    fp.write(chunk)
+                    await bandwidth.consume(len(chunk))
+    
+    os.replace(f"{filename}.part", filename)
+
+def append_file(source, fp):
+    """
+    Appends the file `source` to the unbuffered file object `fp`.
+    The data is copied by the kernel when the platform supports it,
+    otherwise it falls back to a chunked copy.
+    """
+    
+    with open(source, "rb") as src:
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        
         try:
-            for i in download_video(video, speed_var):
-                if downloading_var.get() != video["id"]:
-                    break
+            while offset < size:
+                if hasattr(os, "copy_file_range"):
+                    copied = os.copy_file_range(src.fileno(), fp.fileno(), size - offset)
+                else:
+                    copied = os.sendfile(fp.fileno(), src.fileno(), offset, size - offset)
                 
-                callback(video, i)
-        except (ConnectionAbortedError, ConnectionResetError):
-            logging.info("Connection Error")
+                if not copied:
+                    break
+                offset += copied
+        except (AttributeError, OSError):
+            if offset:
+                raise
+            
+            src.seek(0)
+            shutil.copyfileobj(src, fp)
+
+class Journal():
+    """
+    Records which segments have been written to video.mp4 and where.
+    
+    Each line of journal.txt is "<index> <start> <end>", the byte range
+    of video.mp4 holding every segment up to and including <index>.
+    A line is only written once the segment is on disk, so on opening
+    video.mp4 is cut back to the last recorded end and anything written
+    after it (a crash mid-append) is thrown away.
+    """
+    
+    def __init__(self, folder, video):
+        self.filename = f"{folder}/journal.txt"
+        entries = []
+        
+        try:
+            with open(self.filename) as fp:
+                for line in fp:
+                    try:
+                        index, start, end = map(int, line.split())
+                    except ValueError:
+                        # Partly written line
+                        break
+                    
+                    previous_index, _, previous_end = entries[-1] if entries else (-1, 0, 0)
+                    if index <= previous_index or start != previous_end or end < start:
+                        break
+                    entries.append((index, start, end))
+        except FileNotFoundError:
+            if video["downloaded"]:
+                # Downloaded before journals existed, trust the file as it is.
+                try:
+                    size = os.path.getsize(f"{folder}/video.mp4")
+                except FileNotFoundError:
+                    size = 0
+                entries.append((video["downloaded"] - 1, 0, size))
+        
+        try:
+            size = os.path.getsize(f"{folder}/video.mp4")
+        except FileNotFoundError:
+            size = 0
         
-        logging.info(f"Downloading end | {downloading_var.get()=} / {video['id']=}")
+        while entries and entries[-1][2] > size:
+            entries.pop()
         
-        callback(video)
+        self.end = entries[-1][2] if entries else 0
+        self.downloaded = entries[-1][0] + 1 if entries else 0
+        
+        if size > self.end:
+            logging.info(f"Journal: discarding {size - self.end} bytes of {folder}/video.mp4")
+            with open(f"{folder}/video.mp4", "r+b") as fp:
+                fp.truncate(self.end)
+        
+        with open(f"{self.filename}.tmp", "w") as fp:
+            fp.writelines(f"{index} {start} {end}\n" for index, start, end in entries)
+        os.replace(f"{self.filename}.tmp", self.filename)
+        
+        self.fp = open(self.filename, "a")
+    
+    def commit(self, index, size):
+        self.fp.write(f"{index} {self.end} {self.end + size}\n")
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.end += size
+    
+    def close(self):
+        self.fp.close()
 
-def download_video(video, speed_var):
+def download_video(video, workers):
     yield "Downloading"
     
-    if not os.path.exists(f"Files/{video['id']}/chat.txt"):
+    if not any(os.path.exists(f"Files/{video['id']}/chat.{ext}") for ext in ("bin", "txt")):
         logging.info(f"Downloading chat - {video['id']}")
-        yield from chat(video)
+        yield from chat(video, max(1, workers))
     
     video_folder = f"{info['files'].get(video['id'], info['current_folder'])}/Files/{video['id']}"
     os.makedirs(video_folder, exist_ok=True)
     
-    logging.info(f"Downloading video - {video['id']}")
+    workers = max(1, workers)
+    
+    logging.info(f"Downloading video - {video['id']} | {workers} workers")
     logging.info(f"Downloaded: {video['downloaded']} / Total: {len(video['vod_parts'])}")
     
-    while video["downloaded"] < len(video["vod_parts"]):
-        yield "Downloading"
-        url = f"{video['url']}/{video['vod_parts'][video['downloaded']]}"
-        response = requests.get(url, stream=True)
-        parts = []
-        chunk = 1
-        
-        while chunk:
-            time.sleep(.001)
-            yield "Downloading"
-            chunk = response.raw.read(int(speed_var.get()))
-            parts.append(chunk)
-        yield "Downloading"
-        with open(f"{video_folder}/video.mp4", "ab") as fp:
-            fp.write(b"".join(parts))
-        
-        video["downloaded"] += 1
+    # Up to `workers` segments are fetched at the same time but they are
+    # always written in order so video["downloaded"] stays a valid resume point.
+    # Finished segments wait on disk as <index>.ts until it is their turn,
+    # so memory use doesn't depend on the segment size.
+    pending = {}
+    
+    journal = Journal(video_folder, video)
+    if journal.downloaded != video["downloaded"]:
+        logging.info(f"Journal: {video['id']} resuming from {journal.downloaded} not {video['downloaded']}")
+        video["downloaded"] = journal.downloaded
         video.save()
+    
+    # Segments (finished or not) left over from before the journal's resume point are already in video.mp4
+    for filename in os.listdir(video_folder):
+        if filename.endswith((".ts", ".ts.part")) and int(filename.split(".")[0]) < video["downloaded"]:
+            os.remove(f"{video_folder}/{filename}")
+    
+    # Not opened in append mode, copy_file_range doesn't allow O_APPEND.
+    fd = os.open(f"{video_folder}/video.mp4", os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0))
+    fp = open(fd, "wb", buffering=0)
+    fp.seek(journal.end)
+    
+    try:
+        while video["downloaded"] < len(video["vod_parts"]):
+            index = video["downloaded"]
+            
+            for n in range(index, min(index + workers, len(video["vod_parts"]))):
+                filename = f"{video_folder}/{n}.ts"
+                if n not in pending and not os.path.exists(filename):
+                    url = f"{video['url']}/{video['vod_parts'][n]}"
+                    pending[n] = net.submit(download_segment(url, filename))
+            
+            while index in pending:
+                yield "Downloading"
+                try:
+                    pending[index].result(timeout=.1)
+                except TimeoutError:
+                    continue
+                del pending[index]
+            
+            filename = f"{video_folder}/{index}.ts"
+            size = os.path.getsize(filename)
+            append_file(filename, fp)
+            os.fsync(fp.fileno())
+            journal.commit(index, size)
+            os.remove(filename)
         
-Thread(target=http_thread, daemon=True).start()
-Thread(target=download_thread, daemon=True).start()
-
-def http(*args):
-    thread_queue.put(args)
-
-def download(*args):
-    download_queue.put(args)
-
-class VideoData(dict):
-    videos = {}
+            video["downloaded"] += 1
+            video.save()
+    finally:
+        fp.close()
+        journal.close()
+        for future in pending.values():
+            future.cancel()
+        
+class Scheduler(Thread):
+    """
+    Downloads several videos at the same time.
     
-    def __init__(self, video_id):
-        video_id = str(video_id)
+    Jobs are dicts of {"id", "priority", "paused"} kept in priority order
+    (highest first) and saved to info["download_queue"] whenever they change,
+    so a restart continues where it left off.
+    
+    Listeners are called with (video, progress) while a video downloads and
+    (video, None) once it stops. The download threads queue these in `updates`
+    and drain() calls the listeners from the Tk thread.
+    """
+    
+    def __init__(self):
+        super().__init__(daemon=True)
+        
+        self.condition = Condition()
+        self.jobs = [dict(job) for job in info.get("download_queue", ())]
+        self.active = {}
+        self.listeners = []
+        self.updates = Queue()
+        self.max_videos = info.get("simultaneous_downloads", 2)
+        self.workers = info.get("simultaneous_segments", 4)
+    
+    def job(self, video_id):
+        for job in self.jobs:
+            if job["id"] == video_id:
+                return job
+    
+    def state(self, video_id):
+        job = self.job(video_id)
+        
+        if job is None:
+            return None
+        if video_id in self.active:
+            return "downloading"
+        if job["paused"]:
+            return "paused"
+        return "queued"
+    
+    def label(self, video_id):
+        """The job's place in the queue and its state, for the video list."""
+        
+        with self.condition:
+            job = self.job(video_id)
+            
+            if job is None:
+                return ""
+            return f"{self.jobs.index(job) + 1}. {self.state(video_id).capitalize()}"
+    
+    def save(self):
+        info["download_queue"] = self.jobs
+        info["simultaneous_downloads"] = self.max_videos
+        info["simultaneous_segments"] = self.workers
+        info.save()
+        self.condition.notify_all()
+    
+    def add(self, video_id, priority=0):
+        with self.condition:
+            job = self.job(video_id)
+            
+            if job is None:
+                self.jobs.append({"id": video_id, "priority": priority, "paused": False})
+            else:
+                job.update(priority=priority, paused=False)
+            
+            self.jobs.sort(key=lambda job: -job["priority"])
+            self.save()
+    
+    def pause(self, video_id):
+        with self.condition:
+            job = self.job(video_id)
+            
+            if job:
+                job["paused"] = True
+                self.save()
+    
+    def resume(self, video_id):
+        with self.condition:
+            job = self.job(video_id)
+            
+            if job:
+                job["paused"] = False
+                self.save()
+    
+    def remove(self, video_id):
+        """
+        Takes the job off the queue and waits for its download to stop,
+        after that nothing has the video's files open or saves it again.
+        """
+        
+        with self.condition:
+            job = self.job(video_id)
+            
+            if job:
+                self.jobs.remove(job)
+                self.save()
+            
+            thread = self.active.get(video_id)
+        
+        # The download thread needs the condition to finish, so it's waited for outside it
+        if thread is not None:
+            thread.join()
+    
+    def move(self, video_id, step):
+        """Swaps the job with the job `step` places after it."""
+        
+        with self.condition:
+            job = self.job(video_id)
+            
+            if job is None:
+                return
+            
+            i = self.jobs.index(job)
+            j = i + step
+            if 0 <= j < len(self.jobs):
+                other = self.jobs[j]
+                self.jobs[i], self.jobs[j] = other, job
+                
+                # Taking the priority of the job it swapped with keeps the list sorted.
+                job["priority"] = other["priority"]
+                self.save()
+    
+    def set_limits(self, max_videos=None, workers=None):
+        with self.condition:
+            self.max_videos = max(1, max_videos or self.max_videos)
+            self.workers = max(1, workers or self.workers)
+            self.save()
+    
+    def notify(self, video, progress=None):
+        self.updates.put((video, progress))
+    
+    def drain(self):
+        while not self.updates.empty():
+            video, progress = self.updates.get()
+            
+            for listener in self.listeners:
+                try:
+                    listener(video, progress)
+                except Exception:
+                    logging.exception(f"Listener error | {listener!r}")
+    
+    def run(self):
+        while True:
+            with self.condition:
+                for job in self.jobs:
+                    if len(self.active) >= self.max_videos:
+                        break
+                    
+                    if not job["paused"] and job["id"] not in self.active:
+                        thread = Thread(target=self.download, args=(job,), daemon=True)
+                        self.active[job["id"]] = thread
+                        thread.start()
+                
+                self.condition.wait()
+    
+    def download(self, job):
+        video_id = job["id"]
+        video = None
         
+        logging.info(f"Downloading start | {video_id=}")
+        
+        # Pausing the job on an error stops it being retried straight away.
         try:
-            with open(f"Files/{video_id}/data.txt") as fp:
-                self.update(json.load(fp))
-        except (FileNotFoundError, KeyError):
-            info["files"][video_id] = info["current_folder"]
+            video = VideoData.videos.get(video_id) or VideoData(video_id)
+            
+            for progress in download_video(video, self.workers):
+                if job["paused"] or job not in self.jobs:
+                    break
+                
+                self.notify(video, progress)
+        except (ConnectionAbortedError, ConnectionResetError, *network.ERRORS):
+            logging.info(f"Connection Error | {video_id=}")
+            job["paused"] = True
+        except Exception:
+            logging.exception(f"Download Error | {video_id=}")
+            job["paused"] = True
+        finally:
+            logging.info(f"Downloading end | {video_id=}")
+            net.log_stats()
+        
+            # Always frees the slot, otherwise no other job would start
+            with self.condition:
+                del self.active[video_id]
+            
+                if video is not None and video["downloaded"] == video.parts and job in self.jobs:
+                    self.jobs.remove(job)
+            
+                self.save()
+        
+        if video is not None:
+            self.notify(video)
 
-            parameters = [
-                {
-                    "operationName": "PlaybackAccessToken_Template",
-                    "query": """query PlaybackAccessToken_Template($login: String!, $isLive: Boolean!, $vodID: ID!, $isVod: Boolean!, $playerType: String!) {  streamPlaybackAccessToken(channelName: $login, params: {platform: "web", playerBackend: "mediaplayer", playerType: $playerType}) @include(if: $isLive) {    value    signature    __typename  }  videoPlaybackAccessToken(id: $vodID, params: {platform: "web", playerBackend: "mediaplayer", playerType: $playerType}) @include(if: $isVod) {    value    signature    __typename  }}""",
-                    "variables": {
-                        "isLive": False,
-                        "login": "",
-                        "isVod": True,
-                        "vodID": video_id,
-                        "playerType": "site"
-                    }
-                },
-                {
-                    "operationName": "NielsenContentMetadata",
-                    "variables": {
-                        "isCollectionContent": False,
-                        "isLiveContent": False,
-                        "isVODContent": True,
-                        "collectionID": "",
-                        "login": "",
-                        "vodID": video_id
-                    },
-                    "extensions": {
-                        "persistedQuery": {
-                            "version": 1,
-                            "sha256Hash": "2dbf505ee929438369e68e72319d1106bb3c142e295332fac157c90638968586"
-                        }
-                    }
-                }
-            ]
+class Previews():
+    """
+    Fetches the animated preview sprite sheets of the videos on the browse page.
+    
+    Sheets are fetched on the network loop, at most `workers` at a time, cut into
+    frames on the loop's executor and kept on disk, named by a hash of their URL,
+    so a page opened again doesn't fetch anything.
+    Finished frames wait in `results` until drain() is called from the Tk thread,
+    which is the only place PhotoImages can be made.
+    """
+    
+    # A sprite sheet is FRAMES frames of FRAME_SIZE on top of each other
+    FRAMES = 10
+    FRAME_SIZE = (320, 180)
+    
+    def __init__(self, folder="previews", workers=6, max_size=200*2**20):
+        self.folder = folder
+        self.workers = workers
+        self.max_size = max_size
+        self.semaphore = None
+        self.results = Queue()
+        self.pending = {}
+        self.lock = Lock()
+        
+    def prune(self):
+        """Removes the least recently used sheets until the folder fits in `max_size`."""
+        
+        os.makedirs(self.folder, exist_ok=True)
+        
+        files = [entry for entry in os.scandir(self.folder) if entry.is_file()]
+        files.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        
+        size = 0
+        for entry in files:
+            if not entry.name.endswith(".tmp"):
+                size += entry.stat().st_size
+                if size <= self.max_size:
+                    continue
             
-            response = session.post("https://gql.twitch.tv/gql", json=parameters)
+            os.remove(entry.path)
+    
+    def path(self, url):
+        return f"{self.folder}/{hashlib.sha1(url.encode()).hexdigest()}.jpg"
+    
+    def fetch(self, url, callback):
+        """callback(url, frames) is called by drain(), frames is None if the sheet couldn't be fetched."""
+        
+        with self.lock:
+            if url in self.pending:
+                self.pending[url].append(callback)
+                return
             
-            auth, user_data = response.json()
+            self.pending[url] = [callback]
+        
+        net.submit(self.load(url))
+    
+    def cancel(self):
+        """Drops every callback, sheets that haven't started aren't fetched."""
+        
+        with self.lock:
+            self.pending.clear()
+    
+    async def load(self, url):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        
+        async with self.semaphore:
+            with self.lock:
+                if url not in self.pending:
+                    return
+        
+            frames = None
+        
+            try:
+                data = await self.read(url)
+                frames = await asyncio.get_running_loop().run_in_executor(None, self.split, data)
+            except (OSError, *network.ERRORS) as e:
+                logging.error(f"Preview error: {e!r} | {url=}")
+        
+        with self.lock:
+            callbacks = self.pending.pop(url, None)
+        
+        if callbacks:
+            self.results.put((callbacks, url, frames))
+    
+    async def read(self, url):
+        path = self.path(url)
+        
+        if os.path.exists(path):
+            # Touched so pruning keeps the sheets that are still being used
+            os.utime(path)
+            with open(path, "rb") as fp:
+                return fp.read()
+        
+        response = await net.request("GET", url)
+        response.raise_for_status()
+        
+        with open(f"{path}.tmp", "wb") as fp:
+            fp.write(response.content)
+        os.replace(f"{path}.tmp", path)
+        
+        return response.content
+    
+    def split(self, data):
+        image = Image.open(BytesIO(data))
+        image.load()
+        
+        width, height = self.FRAME_SIZE
+        return [image.crop((0, i*height, width, i*height + height)) for i in range(self.FRAMES)]
+    
+    def drain(self):
+        while not self.results.empty():
+            callbacks, url, frames = self.results.get()
             
-            token = auth["data"]["videoPlaybackAccessToken"]
-            user_data = user_data["data"]["video"]
+            for callback in callbacks:
+                try:
+                    callback(url, frames)
+                except Exception:
+                    logging.exception(f"Preview callback error | {url=}")
+
+previews = Previews()
+
+def http(callback, _type, values, lane=None, group=None):
+    """
+    Calls callback(output) from drain() when the request is done.
+    `lane` defaults to the lane of the request type, `group` is for cancel().
+    """
+    
+    key = _type, values
+    lane = lane or LANE_TYPES[_type]
+    
+    with waiting_lock:
+        request = waiting.get(key)
+        if request is None:
+            request = waiting[key] = {"callbacks": [], "lanes": set(), "tasks": [], "running": False}
+        
+        request["callbacks"].append((callback, group))
+    
+        # Also queued in this lane so a waiting prefetch doesn't hold up the browse page
+        if not request["running"] and lane not in request["lanes"]:
+            request["lanes"].add(lane)
+            request["tasks"].append(net.submit(http_request(key, request, lane)))
+
+def cancel(group):
+    """
+    Drops the callbacks of the requests made with `group`.
+    Requests left without callbacks are cancelled, even ones already being fetched.
+    """
+    
+    with waiting_lock:
+        for key, request in list(waiting.items()):
+            request["callbacks"] = [waiter for waiter in request["callbacks"] if waiter[1] != group]
             
-            url = f"https://usher.ttvnw.net/vod/{video_id}.m3u8"
-            params = {
-                "allow_source": "true",
-                "sig": token['signature'],
-                "token": token["value"]
+            if not request["callbacks"]:
+                del waiting[key]
+                for task in request["tasks"]:
+                    task.cancel()
+        
+        # Finished but not drained yet
+        for request, _ in finished:
+            request["callbacks"] = [waiter for waiter in request["callbacks"] if waiter[1] != group]
+
+def download(video_id, priority=0):
+    scheduler.add(video_id, priority)
+
+async def video_metadata(video_id):
+    """Fetches the playlist and details of a video that hasn't been saved yet."""
+
+    parameters = [
+        {
+            "operationName": "PlaybackAccessToken_Template",
+            "query": """query PlaybackAccessToken_Template($login: String!, $isLive: Boolean!, $vodID: ID!, $isVod: Boolean!, $playerType: String!) {  streamPlaybackAccessToken(channelName: $login, params: {platform: "web", playerBackend: "mediaplayer", playerType: $playerType}) @include(if: $isLive) {    value    signature    __typename  }  videoPlaybackAccessToken(id: $vodID, params: {platform: "web", playerBackend: "mediaplayer", playerType: $playerType}) @include(if: $isVod) {    value    signature    __typename  }}""",
+            "variables": {
+                "isLive": False,
+                "login": "",
+                "isVod": True,
+                "vodID": video_id,
+                "playerType": "site"
             }
+        },
+        {
+            "operationName": "NielsenContentMetadata",
+            "variables": {
+                "isCollectionContent": False,
+                "isLiveContent": False,
+                "isVODContent": True,
+                "collectionID": "",
+                "login": "",
+                "vodID": video_id
+            },
+            "extensions": {
+                "persistedQuery": {
+                    "version": 1,
+                    "sha256Hash": "2dbf505ee929438369e68e72319d1106bb3c142e295332fac157c90638968586"
+                }
+            }
+        }
+    ]
+            
+    _, (auth, user_data) = await gql.post(parameters)
+            
+    token = auth["data"]["videoPlaybackAccessToken"]
+    user_data = user_data["data"]["video"]
             
-            list_url = requests.get(url, params).text.split("\n")
-            video_data = requests.get(list_url[4]).text.split("\n")
+    url = f"https://usher.ttvnw.net/vod/{video_id}.m3u8"
+    params = {
+        "allow_source": "true",
+        "sig": token['signature'],
+        "token": token["value"]
+    }
             
-            self.update({
-                "downloaded": 0,
-                "played": 0,
-                "id": video_id,
-                "title": user_data["title"],
+    list_url = (await net.request("GET", url, params=params)).text.split("\n")
+    video_data = (await net.request("GET", list_url[4])).text.split("\n")
+    
+    return {
+        "downloaded": 0,
+        "played": 0,
+        "id": video_id,
+        "title": user_data["title"],
                 
-                "user_id": user_data["owner"]["id"],
-                "user_name": user_data["owner"]["login"],
-                "estimated_part_size": int(list_url[3].split(",")[0].split("=")[1])/.8,
+        "user_id": user_data["owner"]["id"],
+        "user_name": user_data["owner"]["login"],
+        "estimated_part_size": int(list_url[3].split(",")[0].split("=")[1])/.8,
                 
-                "part_duration": float(video_data[2].split(":")[1]),
-                "total_duration": float(video_data[7].split(":")[1]),
-                "url": list_url[4].rsplit("/", 1)[0],
-                "vod_parts": [v for v in video_data[9:-1:2] if v != "#EXT-X-TWITCH-DISCONTINUITY"]
-            })
+        "part_duration": float(video_data[2].split(":")[1]),
+        "total_duration": float(video_data[7].split(":")[1]),
+        "url": list_url[4].rsplit("/", 1)[0],
+        "vod_parts": [v for v in video_data[9:-1:2] if v != "#EXT-X-TWITCH-DISCONTINUITY"]
+    }
+
+class VideoData(dict):
+    """
+    A video in the library, saved to Files/<id>/data.txt and the library index.
+    Videos made from an index row only hold its summary until a key that isn't
+    in it (like "vod_parts") is used, then data.txt is read.
+    """
+    
+    videos = {}
+    
+    def __init__(self, video_id, metadata=None, summary=None):
+        """
+        `metadata` is the result of video_metadata() when it was already fetched on the network loop.
+        `summary` is the video's row of the library index.
+        """
+        
+        video_id = str(video_id)
+        self.loaded = summary is None
+        # Held while data.txt is read into the summary
+        self.lock = RLock()
+        
+        if summary:
+            self.update(summary)
+        else:
+            self.read(video_id, metadata)
         
         self.videos[video_id] = self
     
+    @classmethod
+    def library(cls):
+        """Every video in the library index, without reading any data.txt."""
+        
+        return [cls(summary["id"], summary=summary) for summary in library.videos()]
+    
+    def read(self, video_id, metadata):
+        try:
+            with open(f"Files/{video_id}/data.txt") as fp:
+                self.update(json.load(fp))
+        except (FileNotFoundError, KeyError):
+            info["files"][video_id] = info["current_folder"]
+            
+            self.update(metadata or net.call(video_metadata(video_id)))
+        
+    def __missing__(self, key):
+        if self.loaded:
+            raise KeyError(key)
+        
+        with self.lock:
+            # Another thread may have read it while this one waited
+            if not self.loaded:
+                with open(f"Files/{self['id']}/data.txt") as fp:
+                    data = json.load(fp)
+        
+                # The index is saved more often (the playback position), its values are newer
+                self.update({name: value for name, value in data.items() if name not in self})
+                self.loaded = True
+                self.pop("parts", None)
+        
+        return self[key]
+    
+    @property
+    def parts(self):
+        with self.lock:
+            return len(self["vod_parts"]) if self.loaded else self["parts"]
+    
     @property
     def values(self):
         played = f"{format_time(self['played'])} / {format_time(self['total_duration'])}"
@@ -275,15 +1080,20 @@ class VideoData(dict):
         return (
             self["user_name"],
             self["title"],
-            f"{self['downloaded'] / len(self['vod_parts']):.2%}",
+            f"{self['downloaded'] / self.parts:.2%}",
+            scheduler.label(self["id"]),
             played
         )
     
     def save(self):
-        os.makedirs(f"Files/{self['id']}", exist_ok=True)
+        # data.txt only needs writing once its data has been read
+        if self.loaded:
+            os.makedirs(f"Files/{self['id']}", exist_ok=True)
         
-        with open(f"Files/{self['id']}/data.txt", "w") as fp:
-            json.dump(self, fp, indent=4, sort_keys=True)
+            with open(f"Files/{self['id']}/data.txt", "w") as fp:
+                json.dump(self, fp, indent=4, sort_keys=True)
+        
+        library.save({**self, "parts": self.parts})
     
     def delete(self):
         shutil.rmtree(f"Files/{self['id']}")
@@ -295,6 +1105,7 @@ class VideoData(dict):
         
         del info["files"][self["id"]]
         del self.videos[self["id"]]
+        library.remove(self["id"])
 
 class Gif():
     """
@@ -304,26 +1115,170 @@ class Gif():
     Valid Image formats are "GIF" and "WEBM".
     Some WEBM Gifs do not have a duration so it is defaulted to 40ms
     Some WEBM Gifs have a duration of 0 so it is defaulted to 40ms.
+    
+    Frames are kept compact: palette frames stay in palette mode and
+    a frame identical to an earlier one is stored once and referenced
+    by self.sequence. Frames are only converted to RGBA when they are used.
     """
     
     def __init__(self, image, duration=40):
-        self.imarray = []
-        for i in range(image.n_frames):
-            image.seek(i)
-            self.imarray.append(image.convert("RGBA"))
+        self.frames, self.sequence = images.compact_frames(image)
+        self.composites = {}
+        self.on_grow = None
+        
         self.duration = image.info.get("duration", duration) or duration
         self.width, self.height = image.size
     
+    @classmethod
+    def from_frames(cls, frames, sequence, duration, size):
+        """Makes a Gif from frames that have already been unpacked by images.compact_frames."""
+        
+        gif = cls.__new__(cls)
+        gif.frames, gif.sequence = frames, sequence
+        gif.composites = {}
+        gif.on_grow = None
+        gif.duration = duration or 40
+        gif.width, gif.height = size
+        
+        return gif
+    
+    @property
+    def size(self):
+        """Approximate memory used by the frames in bytes."""
+        
+        frames = sum(len(frame.mode) * frame.width * frame.height for frame in self.frames)
+        return frames + len(self.composites) * 3 * self.width * self.height
+    
+    def index(self, time):
+        """
+        Returns the index of the frame corresponding to the time in seconds.
+        Repeated frames have the same index.
+        """
+        
+        return self.sequence[int(time * 1000 / self.duration % len(self.sequence))]
+    
     def __getitem__(self, time):
         """Returns the frame corresponding to the time in seconds."""
         
-        return self.imarray[int(time * 1000 / self.duration % len(self.imarray))]
+        return self.frames[self.index(time)].convert("RGBA")
+    
+    def composite(self, index, background):
+        """Returns frame `index` drawn over the background color, made once per color."""
+        
+        if (index, background) not in self.composites:
+            frame = self.frames[index].convert("RGBA")
+            image = Image.new("RGB", frame.size, background)
+            image.paste(frame, (0, 0), frame)
+            self.composites[index, background] = image
+        
+            # Set by the AssetCache holding this Gif so the new composite is counted
+            if self.on_grow:
+                self.on_grow(3 * image.width * image.height)
+        
+        return self.composites[index, background]
+
+class AssetCache():
+    """
+    Decoded emote and badge images shared by every Chat and emote provider.
+    Keyed by the image's file name and limited to `max_size` bytes,
+    the least recently used images are dropped first.
+    """
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = self.misses = 0
+        self.images = OrderedDict()
+        # The size each image was counted with, a Gif grows as composites are added
+        self.sizes = {}
+        self.lock = Lock()
+    
+    @staticmethod
+    def image_size(image):
+        if isinstance(image, Gif):
+            return image.size
+        return len(image.mode) * image.width * image.height
+    
+    def __contains__(self, key):
+        return key in self.images
+    
+    def get(self, key, load):
+        """Returns the image for `key`, calling load() to decode it when it isn't cached."""
+        
+        with self.lock:
+            if key in self.images:
+                self.hits += 1
+                self.images.move_to_end(key)
+                return self.images[key]
+            
+            self.misses += 1
+        
+        # Decoded outside the lock so other threads aren't held up
+        image = load()
+        self.put(key, image)
+        
+        return image
+    
+    def put(self, key, image):
+        with self.lock:
+            if key not in self.images:
+                self.images[key] = image
+                self.sizes[key] = self.image_size(image)
+                self.size += self.sizes[key]
+                
+                if isinstance(image, Gif):
+                    image.on_grow = lambda size: self.grow(key, size)
+                
+                self.evict()
+    
+    def grow(self, key, size):
+        with self.lock:
+            if key in self.images:
+                self.sizes[key] += size
+                self.size += size
+                self.evict()
+    
+    def evict(self):
+        # Called with the lock held
+        while self.size > self.max_size and len(self.images) > 1:
+            key, old = self.images.popitem(last=False)
+            self.size -= self.sizes.pop(key)
+            
+            if isinstance(old, Gif):
+                old.on_grow = None
+    
+    def log_stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0
+        logging.info(f"Asset cache: {len(self.images)} images / {self.size} bytes | {self.hits} hits / {self.misses} misses ({ratio:.2%})")
+
+assets = AssetCache(64 * 2**20)
+
+def load_image(filename):
+    image = Image.open(pack.open(filename))
+    if image.format in ("WEBP", "GIF"):
+        return Gif(image)
+    return image.convert("RGBA")
+
+def restore_image(decoded):
+    """Turns the result of images.decode back into an image or Gif."""
+    
+    if decoded[0] == "gif":
+        _, frames, sequence, duration, size = decoded
+        return Gif.from_frames([images.load_frame(*frame) for frame in frames], sequence, duration, size)
+    
+    return images.load_frame(*decoded[1])
+
+# Emote files known to be on disk, shared so a new cache doesn't check them again
+saved_files = set()
 
 class BaseCache():
     def __init__(self, video, update, folder, user, global_url, channel_url, emote_url):
         self.emote_url = emote_url
         self.folder = folder
         
+        global_emotes, channel_emotes = {}, {}
+        
         try:
             with open(f"{folder}/global.txt") as fp:
                 global_emotes = json.load(fp)
@@ -334,11 +1289,11 @@ class BaseCache():
             pass
             
         if update:
-            global_emotes.update(self.parse(session.get(global_url).json()))
+            global_emotes.update(self.parse(get(global_url).json()))
             with open(f"{folder}/global.txt", "w") as fp:
                 json.dump(global_emotes, fp, indent=4, sort_keys=True)
             
-            channel_emotes.update(self.parse(session.get(channel_url.format(video[user])).json()))
+            channel_emotes.update(self.parse(get(channel_url.format(video[user])).json()))
             with open(f"{folder}/{video[user]}.txt", "w") as fp:
                 json.dump(channel_emotes, fp, indent=4, sort_keys=True)
             
@@ -347,7 +1302,6 @@ class BaseCache():
     def __contains__(self, item):
         return item in self.emotes
 
-    @lru_cache(maxsize=None)
     def __call__(self, word):
         # Function for saving emotes
         
@@ -355,26 +1309,27 @@ class BaseCache():
             return
             
         filename = f"{self.folder}/{self.emotes[word]}"
-        if os.path.exists(filename):
+        if filename in saved_files:
             return
             
-        with open(filename, "wb") as fp:
-            url = self.emote_url.format(self.emotes[word].split(".")[0])
-            fp.write(session.get(url).content)
+        if filename not in pack:
+            save_file(filename, self.url(word))
+        saved_files.add(filename)
+    
+    def url(self, word):
+        return self.emote_url.format(self.emotes[word].split(".")[0])
     
-    @lru_cache(maxsize=None)
     def __getitem__(self, word):
         # Function for getting emote images
         
         filename = f"{self.folder}/{self.emotes[word]}"
         
-        if not os.path.exists(filename):
-            self(word)
+        return assets.get(filename, lambda: self.load(word))
+    
+    def load(self, word):
+        self(word)
             
-        image = Image.open(filename)
-        if image.format in ("WEBP", "GIF"):
-            return Gif(image)
-        return image.convert("RGBA")
+        return load_image(f"{self.folder}/{self.emotes[word]}")
 
 class BadgeCache(BaseCache):
     def __init__(self, video, update=False):
@@ -438,72 +1393,241 @@ class _7tvCache(BaseCache):
             for item in response
         } if isinstance(response, list) else {}
 
-@lru_cache(maxsize=None)
-def twitch_emote(emoticon_id):
-    """Function for saving Twitch emotes."""
+async def save_asset(filename, url):
+    """Downloads `url` into the asset pack as `filename`."""
     
-    filename = f"twitch_emotes/{emoticon_id}.png"
-    if os.path.exists(filename):
-        return
-        
-    url = f"https://static-cdn.jtvnw.net/emoticons/v1/{emoticon_id}/1.0"
-    with open(filename, "wb") as fp:
-        fp.write(session.get(url).content)
+    response = await fetch(url)
+    
+    if response.status_code == 200:
+        pack.add(filename, response.content)
+    else:
+        logging.error(f"Could not download {filename}: {response.status_code}")
 
-def chat(video):
-    # Downloads the Twitch chat.
+async def save_assets(downloads, limit=32):
+    """Downloads every {filename: url} in `downloads`, at most `limit` at a time."""
     
-    url = f"https://api.twitch.tv/v5/videos/{video['id']}/comments"
-    parameters = {"content_offset_seconds": 0}
+    semaphore = asyncio.Semaphore(limit)
     
-    comments = []
-    badge_cache = BadgeCache(video, True)
-    emote_caches = (BttvCache(video, True), FfzCache(video, True), _7tvCache(video, True))
+    async def save(filename, url):
+        async with semaphore:
+            try:
+                await save_asset(filename, url)
+            except network.ERRORS as e:
+                logging.error(f"Could not download {filename}: {e!r}")
     
-    while True:
-        response = session.get(url, params=parameters).json()
+    await asyncio.gather(*(save(filename, url) for filename, url in downloads.items()))
+
+def save_file(filename, url):
+    """save_asset() for threads."""
+    
+    net.call(save_asset(filename, url))
+
+class EmoteTable():
+    """
+    The emotes of one video, resolved while its chat is downloaded.
+    
+    self.codes merges the BTTV, FFZ and 7TV emotes into one dict, with BTTV
+    taking priority over FFZ and FFZ over 7TV when they share a code.
+    self.files is the emote table saved with the chat, messages refer to
+    emotes (Twitch emotes included) by their index in it.
+    self.downloads is {filename: url} of the emotes and badges that aren't in the
+    asset pack yet, they're all downloaded together once the chat is.
+    """
+    
+    def __init__(self, video, update=False, download=True):
+        self.download = download
+        self.codes = {}
+        for cache in (_7tvCache(video, update), FfzCache(video, update), BttvCache(video, update)):
+            self.codes.update(dict.fromkeys(cache.emotes, cache))
         
-        for item in response["comments"]:
-            data = {
-                "name": item["commenter"]["display_name"],
-                "offset": item["content_offset_seconds"]
-            }
+        self.files = []
+        self.indexes = {}
+        self.downloads = {}
+        self.lock = Lock()
+    
+    def add(self, filename):
+        with self.lock:
+            if filename not in self.indexes:
+                self.indexes[filename] = len(self.files)
+                self.files.append(filename)
+            
+            return self.indexes[filename]
+    
+    def need(self, filename, url):
+        """Returns `filename`, remembering to download it from `url` if it isn't saved."""
+        
+        if self.download and filename not in pack:
+            self.downloads[filename] = url
+        
+        return filename
+    
+    def tokenize(self, text):
+        """Splits text into words, spaces and emote indexes."""
+        
+        tokens = []
+        
+        # Splitting on "( )" keeps the spaces
+        for word in re.split("( )", text):
+            if word == "":
+                continue
             
-            message = item["message"]
+            cache = self.codes.get(word)
+            if cache is None:
+                tokens.append(word)
+            else:
+                filename = self.need(f"{cache.folder}/{cache.emotes[word]}", cache.url(word))
+                tokens.append(self.add(filename))
+        
+        return tokens
+    
+    def tokenize_message(self, data):
+        """Converts a message in the old chat.txt format to the format saved in chat.bin."""
+        
+        fragments = data.pop("fragments")
+        data["tokens"] = []
+        
+        if isinstance(fragments, str):
+            # message doesn't have a fragment if it is a highlighted message.
+            fragments = [{"text": fragments}]
+        
+        for fragment in fragments:
+            if fragment.get("emoticon"):
+                filename = self.need(
+                    f"twitch_emotes/{fragment['emoticon']}.png",
+                    f"https://static-cdn.jtvnw.net/emoticons/v1/{fragment['emoticon']}/1.0"
+                )
+                data["tokens"].append(self.add(filename))
+            else:
+                data["tokens"].extend(self.tokenize(fragment["text"]))
+        
+        return data
+
+def parse_comment(item, badge_cache, table):
+    """Converts a comment from the API into the format saved in chat.bin and notes its emotes for downloading."""
+    
+    data = {
+        "name": item["commenter"]["display_name"],
+        "offset": item["content_offset_seconds"]
+    }
             
-            data["badges"] = message.get("user_badges", ())
-            for badge in data["badges"]:
-                badge_cache(f'{badge["_id"]}/{badge["version"]}')
+    message = item["message"]
+            
+    data["badges"] = message.get("user_badges", ())
+    for badge in data["badges"]:
+        code = f'{badge["_id"]}/{badge["version"]}'
+        if code in badge_cache:
+            table.need(f"badges/{badge_cache.emotes[code]}", badge_cache.url(code))
                     
-            data["color"] = message.get("user_color")
-                
-            if message.get("fragments"):
-                data["fragments"] = []
-                
-                for fragment in message["fragments"]:
-                    if fragment.get("emoticon"):
-                        data["fragments"].append({
-                            "emoticon": fragment["emoticon"]["emoticon_id"]
-                        })
-                        twitch_emote(fragment["emoticon"]["emoticon_id"])
-                    else:
-                        data["fragments"].append(fragment)
-                        for word in fragment["text"].split():
-                            for emote_cache in emote_caches:
-                                emote_cache(word)
-            else:
-                # message doesn't have a fragment if it is a highlighted message.
+    data["color"] = message.get("user_color")
                 
-                data["fragments"] = message["body"]   
+    if message.get("fragments"):
+        data["fragments"] = [
+            {"emoticon": fragment["emoticon"]["emoticon_id"]} if fragment.get("emoticon") else fragment
+            for fragment in message["fragments"]
+        ]
+    else:
+        data["fragments"] = message["body"]
             
-            comments.append(json.dumps(data))
+    return table.tokenize_message(data)
+
+async def chat_range(video, start, end, badge_cache, table, progress):
+    """
+    Runs on the network loop.
+    Downloads the comments with an offset from `start` up to `end` seconds
+    and returns them as (comment id, data) pairs.
+    """
+    
+    url = f"https://api.twitch.tv/v5/videos/{video['id']}/comments"
+    parameters = {"content_offset_seconds": start}
+    
+    comments = []
+    
+    while True:
+        response = (await fetch(url, params=parameters)).json()
+        
+        for item in response["comments"]:
+            if item["content_offset_seconds"] >= end:
+                return comments
             
-        yield len(comments)
+            # The first page can start slightly before `start`
+            if item["content_offset_seconds"] >= start:
+                comments.append((item["_id"], parse_comment(item, badge_cache, table)))
+        
+        progress.put(len(response["comments"]))
             
         if response.get("_next"):
             parameters = {"cursor": response["_next"]}
         else:
-            break
+            return comments
+
+def chat(video, workers=1):
+    # Downloads the Twitch chat.
+    # The video is split into `workers` time ranges which are downloaded at the same time.
+    
+    badge_cache = BadgeCache(video, True)
+    table = EmoteTable(video, True)
+    
+    step = video["total_duration"] / workers
+    ranges = [(i * step, (i + 1) * step) for i in range(workers)]
+    ranges[-1] = ranges[-1][0], float("inf")
+    
+    progress = Queue()
+    count = 0
+    
+    futures = [
+        net.submit(chat_range(video, start, end, badge_cache, table, progress))
+        for start, end in ranges
+    ]
+        
+    try:
+        while not all(future.done() for future in futures):
+            wait(futures, timeout=.1)
+            
+            while not progress.empty():
+                count += progress.get()
+            yield count
+        
+        # Ranges can overlap by a page so duplicates are removed by comment id
+        comments = {}
+        for future in futures:
+            comments.update(future.result())
+    
+        logging.info(f"Downloading {len(table.downloads)} emotes and badges - {video['id']}")
+        futures = [net.submit(save_assets(table.downloads))]
+        
+        while not futures[0].done():
+            wait(futures, timeout=.1)
+            yield count
+        futures[0].result()
+    finally:
+        # Stopping the download stops every page and emote still being fetched
+        for future in futures:
+            future.cancel()
+    
+    store.write(
+        f"Files/{video['id']}/chat.bin",
+        sorted(comments.values(), key=lambda data: data["offset"]),
+        table.files
+    )
+
+def init():
+    """Called once by main before the downloader is used."""
+    
+    global info, pack, library, scheduler
+    
+    for folder in ("Files", *ASSET_FOLDERS):
+        os.makedirs(folder, exist_ok=True)
+    
+    # Emote and badge images are kept in one file, images still in
+    # their folders from older versions are moved into it.
+    pack = store.AssetPack("assets.pack")
+    pack.migrate(ASSET_FOLDERS)
+    
+    # The video list is read from one index, videos from older versions are added to it.
+    library = store.Library("library.db")
+    library.migrate("Files")
     
-    with open(f"Files/{video['id']}/chat.txt", "w") as fp:
-        fp.write("\n".join(comments))
\ No newline at end of file
+    info = Info()
+    net.start()
+    scheduler = Scheduler()
+    previews.prune()
@@ -0,0 +1,79 @@
+from io import BytesIO
+
+from PIL import Image
+
+# Image decoding shared by the chat and the prewarm worker processes.
+# The workers are spawned, which also imports the main script (vlc, tkinter, aiohttp
+# and the chat font), so they're slow to start and chat keeps one pool for the session.
+
+def compact_frames(image):
+    """
+    Returns the frames of an animated image as (frames, sequence).
+    Palette frames stay in palette mode and a frame identical to an earlier one
+    is only in `frames` once, `sequence` is the index of each frame in `frames`.
+    """
+    
+    frames = []
+    sequence = []
+    unique = {}
+    
+    for i in range(image.n_frames):
+        image.seek(i)
+        frame = image.copy() if image.mode in ("P", "L") else image.convert("RGBA")
+        
+        palette = frame.getpalette() if frame.mode == "P" else None
+        key = frame.mode, frame.tobytes(), bytes(palette or ()), frame.info.get("transparency")
+        
+        if key not in unique:
+            unique[key] = len(frames)
+            frames.append(frame)
+        sequence.append(unique[key])
+    
+    return frames, sequence
+
+def pad_badge(image):
+    """Badges are drawn on a 20x21 image so they line up with the text."""
+    
+    padded = Image.new("RGBA", (20, 21))
+    badge = image.convert("RGBA")
+    padded.paste(badge, (0, 0), badge)
+    
+    return padded
+
+def dump_frame(frame):
+    palette = frame.getpalette() if frame.mode == "P" else None
+    return frame.mode, frame.size, frame.tobytes(), palette, frame.info.get("transparency")
+
+def load_frame(mode, size, data, palette, transparency):
+    frame = Image.frombytes(mode, size, data)
+    
+    if palette:
+        frame.putpalette(palette)
+    if transparency is not None:
+        frame.info["transparency"] = transparency
+    
+    return frame
+
+def decode(filename, data, badge=False):
+    """
+    Runs in a worker process.
+    Decodes the image file `data` into plain values that can be sent back to the
+    main process, where downloader.restore_image turns them back into images.
+    """
+    
+    image = Image.open(BytesIO(data))
+    
+    if badge:
+        return filename, ("image", dump_frame(pad_badge(image)))
+    
+    if image.format in ("WEBP", "GIF"):
+        frames, sequence = compact_frames(image)
+        return filename, (
+            "gif",
+            [dump_frame(frame) for frame in frames],
+            sequence,
+            image.info.get("duration"),
+            image.size
+        )
+    
+    return filename, ("image", dump_frame(image.convert("RGBA")))
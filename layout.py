@@ -55,7 +55,6 @@ class Layout(tk.Tk):
         self.bind("<Escape>", lambda args: self.end())
         self.bind("<Double-Button-1>", self.fullscreen)
         self.download_btns = {}
-        self.downloading = tk.StringVar()
         self.old_geometry = None
         self.playing = tk.StringVar()
         
@@ -210,6 +209,11 @@ class Layout(tk.Tk):
         self.delete_btn = ttk.Button(frame, text="Delete", command=self.delete, state="disabled")
         self.delete_btn.grid(column=1, row=2, padx=5, pady=5, sticky="e")
         
+        move_frame = ttk.Frame(frame)
+        move_frame.grid(column=0, row=2, sticky="w")
+        ttk.Button(move_frame, text="Move Up", command=lambda: self.move(-1)).grid(column=0, row=0, padx=5, pady=5)
+        ttk.Button(move_frame, text="Move Down", command=lambda: self.move(1)).grid(column=1, row=0, padx=5, pady=5)
+        
         self.tv = Tree(frame)
         self.tv["selectmode"] = "browse"
         self.tv.bind('<<TreeviewSelect>>', self.tv_select)
@@ -234,8 +238,8 @@ class Layout(tk.Tk):
         entry.grid(column=1, row=1, padx=5, pady=5, sticky="w")
         entry.bind("<ButtonRelease-1>", self.paste)
         
-        self.speed_var = tk.IntVar(value=12000)
-        lbl = ttk.Label(frame, text="Download Speed: ")
+        self.speed_var = tk.IntVar(value=0)
+        lbl = ttk.Label(frame, text="Download Speed (KB/s, 0 = unlimited): ")
         lbl.grid(column=0, row=2, padx=5, pady=5, sticky="e")
         vcmd = (self.register(validate), '%P', '%S')
         spinbox = ttk.Spinbox(
@@ -247,20 +251,44 @@ class Layout(tk.Tk):
         )
         spinbox.grid(column=1, row=2, padx=5, pady=5, sticky="w")
         
+        self.workers_var = tk.IntVar(value=4)
+        lbl = ttk.Label(frame, text="Simultaneous Segments: ")
+        lbl.grid(column=0, row=3, padx=5, pady=5, sticky="e")
+        spinbox = ttk.Spinbox(
+            frame, from_=1, to_=32,
+            textvariable=self.workers_var,
+            validate="key",
+            validatecommand=vcmd,
+            width=50
+        )
+        spinbox.grid(column=1, row=3, padx=5, pady=5, sticky="w")
+        
+        self.videos_var = tk.IntVar(value=2)
+        lbl = ttk.Label(frame, text="Simultaneous Downloads: ")
+        lbl.grid(column=0, row=4, padx=5, pady=5, sticky="e")
+        spinbox = ttk.Spinbox(
+            frame, from_=1, to_=8,
+            textvariable=self.videos_var,
+            validate="key",
+            validatecommand=vcmd,
+            width=50
+        )
+        spinbox.grid(column=1, row=4, padx=5, pady=5, sticky="w")
+        
         btn = ttk.Button(frame, text="Select File", command=lambda: self.select(fd))
-        btn.grid(column=0, row=3, padx=5, pady=5, sticky="e")
+        btn.grid(column=0, row=5, padx=5, pady=5, sticky="e")
         
         self.folder_var = tk.StringVar()
         entry = ttk.Entry(frame, textvariable=self.folder_var, state="disabled", width=50)
-        entry.grid(column=1, row=3, padx=5, pady=5, sticky="w")
+        entry.grid(column=1, row=5, padx=5, pady=5, sticky="w")
         
-        ttk.Label(frame, text="Keyboard Controls:").grid(column=0, row=4, padx=5, pady=5, sticky="w")
-        ttk.Label(frame, text="Seek video -10 seconds: ").grid(column=0, row=5, padx=5, pady=5, sticky="e")
-        ttk.Label(frame, text="Left Arrow").grid(column=1, row=5, padx=5, pady=5, sticky="w")
-        ttk.Label(frame, text="Seek video +10 seconds: ").grid(column=0, row=6, padx=5, pady=5, sticky="e")
-        ttk.Label(frame, text="Right Arrow").grid(column=1, row=6, padx=5, pady=5, sticky="w")
-        ttk.Label(frame, text="Quit: ").grid(column=0, row=7, padx=5, pady=5, sticky="e")
-        ttk.Label(frame, text="Escape").grid(column=1, row=7, padx=5, pady=5, sticky="w")
+        ttk.Label(frame, text="Keyboard Controls:").grid(column=0, row=6, padx=5, pady=5, sticky="w")
+        ttk.Label(frame, text="Seek video -10 seconds: ").grid(column=0, row=7, padx=5, pady=5, sticky="e")
+        ttk.Label(frame, text="Left Arrow").grid(column=1, row=7, padx=5, pady=5, sticky="w")
+        ttk.Label(frame, text="Seek video +10 seconds: ").grid(column=0, row=8, padx=5, pady=5, sticky="e")
+        ttk.Label(frame, text="Right Arrow").grid(column=1, row=8, padx=5, pady=5, sticky="w")
+        ttk.Label(frame, text="Quit: ").grid(column=0, row=9, padx=5, pady=5, sticky="e")
+        ttk.Label(frame, text="Escape").grid(column=1, row=9, padx=5, pady=5, sticky="w")
         
         return frame
         
@@ -273,6 +301,9 @@ class Layout(tk.Tk):
     def download(self):
         print("download")
     
+    def move(self, step):
+        print("move")
+    
     def load(self):
         print("load")
     
@@ -368,6 +399,7 @@ class Tree(ttk.Treeview):
             ("Streamer", 100),
             ("Title", 400),
             ("Downloaded", 80),
+            ("Queue", 110),
             ("Played", 30)
         ]
         
@@ -1,7 +1,5 @@
 from tkinter import BooleanVar, ttk, TclError, messagebox, Tk
 from datetime import datetime
-import io
-import os
 import time
 import traceback
 import logging
@@ -48,15 +46,12 @@ class GIF():
         if url in self.cache:
             self.images = self.cache[url]
         else:
-            downloader.http(self.callback, "preview", url)
-            
-    def _callback(self, status_code, url, image_data=None):
-        if status_code == 200:
-            image = Image.open(io.BytesIO(image_data))
-            self.cache[url] = self.images = [
-                ImageTk.PhotoImage(image.crop((0, i*180, 320, i*180+180)))
-                for i in range(10)
-            ]
+            downloader.previews.fetch(url, self.callback)
+    
+    def _callback(self, url, frames):
+        # Frames are fetched and cut in downloader.previews, only the PhotoImages are made here
+        if frames:
+            self.cache[url] = self.images = [ImageTk.PhotoImage(frame) for frame in frames]
         else:
             self.cache[url] = self.images = [GIF.blank]*10
     
@@ -80,9 +75,18 @@ class Main(Layout):
         
         self.geometry(downloader.info.get("geometry", "1474x735+119+184"))
         def client_id(*args):
-            downloader.session.headers["Client-ID"] = downloader.info["client_id"] = self.client_id_var.get()
+            downloader.net.headers["Client-ID"] = downloader.info["client_id"] = self.client_id_var.get()
         self.client_id_var.trace_add("write", client_id)
         self.client_id_var.set(downloader.info["client_id"])
+        
+        def speed(*args):
+            try:
+                downloader.bandwidth.set_rate(self.speed_var.get() * 1024)
+            except TclError:
+                # Spinbox is empty while the user is typing
+                pass
+        self.speed_var.trace_add("write", speed)
+        self.speed_var.set(downloader.info.get("speed", 0))
         self.folder_var.set(downloader.info["current_folder"])
         
         self.gifs = []
@@ -96,9 +100,27 @@ class Main(Layout):
         
         if downloader.info.get("streamers"):
             self.box.insert(0, *sorted(downloader.info["streamers"]))
-        
-        for filename in sorted(os.listdir("Files")):
-            self.add_section(downloader.VideoData(filename))
+            
+            # Video lists are fetched in the background (batched by downloader.gql)
+            # so the first click on a saved streamer is answered from the cache.
+            for login in downloader.info["streamers"]:
+                downloader.http(lambda _: None, "past_broadcasts", (login, ""), lane="prefetch")
+        
+        for video in downloader.VideoData.library():
+            self.add_section(video)
+        
+        def limits(*args):
+            try:
+                downloader.scheduler.set_limits(self.videos_var.get(), self.workers_var.get())
+            except TclError:
+                pass
+        self.videos_var.set(downloader.scheduler.max_videos)
+        self.workers_var.set(downloader.scheduler.workers)
+        self.videos_var.trace_add("write", limits)
+        self.workers_var.trace_add("write", limits)
+        
+        downloader.scheduler.listeners.append(self.download_callback)
+        downloader.scheduler.start()
         
         self.instance = vlc.Instance("--verbose -1")
         self.player = self.instance.media_player_new()
@@ -147,13 +169,22 @@ class Main(Layout):
             for child in children:
                 child.destroy()
                 
+            # Nothing still waiting for the last streamer is needed anymore
+            downloader.cancel("browse")
+            downloader.previews.cancel()
+            
             downloader.http(
                 self.listbox_select_callback,
                 "past_broadcasts",
-                (self.box.get(selection[0]), "")
+                (self.box.get(selection[0]), ""),
+                group="browse"
             )
     
     def tick(self):
+        downloader.drain()
+        downloader.previews.drain()
+        downloader.scheduler.drain()
+        
         for gif in self.gifs:
             gif.set(time.time())
         
@@ -201,7 +232,7 @@ class Main(Layout):
             self.notebook.select(3)
             return
         
-        user = data.json()[0]["data"]["user"]
+        user = data[0]["data"]["user"]
         
         if user is None:
             return ttk.Label(self.video_grid, text="User not found.").grid()
@@ -262,41 +293,52 @@ class Main(Layout):
             pass
     
     def download(self, video_id=None):
-        if self.download_btn["text"] == "Stop Download":
-            self.downloading.set("")
-            self.download_btn["text"] = "Download"
-            return
-        
         video_id = video_id or self.tv.selection()[0]
-        self.downloading.set(video_id)
-        self.download_btn["text"] = "Stop Download"
-        
-        downloader.download(
-            self.download_callback,
-            self.videos[video_id],
-            self.speed_var,
-            self.downloading
-        )
+        
+        state = downloader.scheduler.state(video_id)
+        
+        if state in ("downloading", "queued"):
+            downloader.scheduler.pause(video_id)
+        elif state == "paused":
+            # Keeps the priority it was given with Move Up/Move Down
+            downloader.scheduler.resume(video_id)
+        else:
+            downloader.download(video_id)
+        
+        self.show_queue()
+        self.tv_select(None)
+    
+    def move(self, step):
+        selection = self.tv.selection()
+        
+        if selection:
+            downloader.scheduler.move(selection[0], step)
+            self.show_queue()
     
     def download_callback(self, video, x=None):
-        title, streamer, downloaded, played = video.values
+        # Called from downloader.scheduler.drain in tick
+        
+        # Deleted while it was downloading
+        if not self.tv.exists(video["id"]):
+            return
+        
+        title, streamer, downloaded, queue, played = video.values
         
         if isinstance(x, int):
-            title, streamer, downloaded, played = title, streamer, f"Chat: {x}", played
+            downloaded = f"Chat: {x}"
         
-        self.tv.item(video["id"], values=(title, streamer, downloaded, played))
+        self.tv.item(video["id"], values=(title, streamer, downloaded, queue, played))
         
         if x is None:
-            self.downloading.set("")
+            # The job has left the queue or been paused, the ones after it moved up
+            self.show_queue()
             
             if self.tv.selection() == (video["id"],):
-                self.btn_state("finished_download")
-        
-        if video["downloaded"] == len(video["vod_parts"]):
-            for item in self.tv.get_children():
-                if self.tv.item(item, "values")[2] != "100.00%":
-                    self.download(item)
-                    break
+                self.tv_select(None)
+    
+    def show_queue(self):
+        for video_id in self.tv.get_children():
+            self.tv.set(video_id, "Queue", downloader.scheduler.label(video_id))
     
     def select(self, filedialog):
         folder = filedialog.askdirectory()
@@ -307,8 +349,8 @@ class Main(Layout):
     def delete(self):
         selection, = self.tv.selection()
         
-        if self.downloading.get() == selection:
-            self.downloading.set("")
+        downloader.scheduler.remove(selection)
+        self.show_queue()
         
         if self.playing.get() == selection:
             self.playing.set("")
@@ -332,6 +374,8 @@ class Main(Layout):
         self.scale.configure(to_=int(video["total_duration"] * 1000))
         self.play()
         self.tv.item(selection, tags="played")
+        if self.chat:
+            self.chat.stop()
         self.chat = Chat(video, self.chat_window)
         
         # resume
@@ -381,14 +425,14 @@ class Main(Layout):
         if self.has_next_page:
             self.has_next_page = False
             values = (self.box.get(selection[0]), self.cursor[1]) if selection else self.cursor
-            downloader.http(self.listbox_select_callback, "past_broadcasts", values)
+            downloader.http(self.listbox_select_callback, "past_broadcasts", values, group="browse")
     
     def tv_select(self, _):
         video = self.videos[self.tv.selection()[0]]
         
-        if self.downloading.get() == video["id"]:
+        if downloader.scheduler.state(video["id"]) in ("downloading", "queued"):
             self.btn_state("downloading")
-        elif video["downloaded"] < len(video["vod_parts"]):
+        elif video["downloaded"] < video.parts:
             self.btn_state("pending_download")
         else:
             self.btn_state("finished_download")
@@ -412,6 +456,8 @@ class Main(Layout):
         
             self.player.set_time(current_time + delta * 1000)
             self.chat.seek(current_time / 1000 + delta)
+            # tick passes the chat the time from before the seek otherwise
+            self.videos[self.playing.get()]["played"] = current_time / 1000 + delta
     
     def pressed(self, args):
         self.press = True
@@ -427,10 +473,14 @@ class Main(Layout):
             if self.chat:
                 self.chat.seek(current_time / 1000)
             
+            if self.playing.get():
+                self.videos[self.playing.get()]["played"] = current_time / 1000
+            
     def end(self):
         downloader.info["geometry"] = self.old_geometry or self.geometry()
         downloader.info["streamers"] = self.box.get(0, "end")
         downloader.info["volume"] = self.volVar.get()
+        downloader.info["speed"] = downloader.bandwidth.rate // 1024
         downloader.info.save()
         
         for video in self.videos.values():
@@ -439,4 +489,5 @@ class Main(Layout):
         self.destroy()
 
 if __name__ == "__main__":
+    downloader.init()
     Main()
\ No newline at end of file
@@ -0,0 +1,112 @@
+from collections import Counter
+from threading import Event, Lock, Thread
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+# Every request the downloader makes runs as a task on one asyncio event loop,
+# on its own thread with one connection pool, so hundreds of requests in flight
+# cost a single thread instead of one each.
+#
+# Other threads hand coroutines to the loop with submit(), which returns a
+# concurrent.futures.Future (cancelling it cancels the task), or call(), which
+# waits for the result. Neither can be used from the loop thread itself.
+
+# Errors a request can fail with
+ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+class HTTPError(aiohttp.ClientError):
+    pass
+
+class Response():
+    """A finished response, the body has already been read."""
+    
+    def __init__(self, status_code, url, content):
+        self.status_code = status_code
+        self.url = url
+        self.content = content
+    
+    @property
+    def text(self):
+        return self.content.decode()
+    
+    def json(self):
+        return json.loads(self.content)
+    
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError(f"{self.status_code} | {self.url}")
+
+class Network(Thread):
+    """
+    The event loop thread.
+    `headers` are sent with every request (for the Client-ID) and can be changed at any time.
+    """
+    
+    def __init__(self, connections=100, connections_per_host=32):
+        super().__init__(daemon=True, name="network")
+        
+        self.connections = connections
+        self.connections_per_host = connections_per_host
+        self.headers = {}
+        self.loop = asyncio.new_event_loop()
+        self.started = Event()
+        
+        self.lock = Lock()
+        self.opened = Counter()
+        self.sent = Counter()
+    
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.session = self.loop.run_until_complete(self.open())
+        self.started.set()
+        self.loop.run_forever()
+    
+    async def open(self):
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self.on_request)
+        trace.on_connection_create_end.append(self.on_connection)
+        
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections, limit_per_host=self.connections_per_host),
+            timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=60),
+            trace_configs=[trace]
+        )
+    
+    async def on_request(self, session, context, params):
+        context.host = params.url.host
+        with self.lock:
+            self.sent[context.host] += 1
+    
+    async def on_connection(self, session, context, params):
+        with self.lock:
+            self.opened[context.host] += 1
+    
+    def submit(self, coroutine):
+        """Runs `coroutine` on the loop, returns a concurrent.futures.Future of its result."""
+        
+        self.started.wait()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+    
+    def call(self, coroutine):
+        """Runs `coroutine` on the loop and waits for its result."""
+        
+        return self.submit(coroutine).result()
+    
+    def stream(self, method, url, **kwargs):
+        """session.request for reading the body in chunks, use with `async with`."""
+        
+        headers = {**self.headers, **kwargs.pop("headers", {})}
+        return self.session.request(method, url, headers=headers, **kwargs)
+    
+    async def request(self, method, url, **kwargs):
+        async with self.stream(method, url, **kwargs) as response:
+            return Response(response.status, str(response.url), await response.read())
+    
+    def log_stats(self):
+        with self.lock:
+            for host, sent in self.sent.items():
+                opened = self.opened[host]
+                logging.info(f"Connections: {host} | {opened} opened / {sent - opened} reused")
@@ -0,0 +1,376 @@
+from io import BytesIO
+from threading import Lock
+import json
+import mmap
+import os
+import sqlite3
+import struct
+
+# Compact on-disk chat format (chat.bin).
+#
+#   header   magic, message count, position of the string table, position of the index
+#   records  one packed record per message
+#   strings  names, colors, badges and emote files, each stored once
+#   emotes   the video's emote table, the emote files messages refer to by index
+#   index    (offset in seconds, record position) for every message, fixed width
+#
+# Message text is stored already split into tokens: words and spaces are strings
+# and emotes are indexes into the emote table, so nothing is looked up when drawing.
+#
+# The file is memory-mapped and messages are only decoded when they are read.
+
+MAGIC = b"TPCHAT\x00\x02"
+HEADER = struct.Struct("<8sIQQQ")
+INDEX = struct.Struct("<dQ")
+NONE = 0xFFFFFFFF
+
+TEXT, EMOTE = range(2)
+
+class Writer():
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(f"{filename}.tmp", "wb")
+        self.fp.write(HEADER.pack(MAGIC, 0, 0, 0, 0))
+        
+        self.strings = {}
+        self.index = []
+    
+    def string(self, value):
+        if value is None:
+            return NONE
+        
+        return self.strings.setdefault(value, len(self.strings))
+    
+    def append(self, message):
+        self.index.append(INDEX.pack(message["offset"], self.fp.tell()))
+        
+        record = [struct.pack(
+            "<IIH",
+            self.string(message["name"]),
+            self.string(message.get("color")),
+            len(message.get("badges", ()))
+        )]
+        
+        for badge in message.get("badges", ()):
+            record.append(struct.pack("<II", self.string(badge["_id"]), self.string(badge["version"])))
+        
+        record.append(struct.pack("<H", len(message["tokens"])))
+        
+        for token in message["tokens"]:
+            if isinstance(token, int):
+                record.append(struct.pack("<BI", EMOTE, token))
+            else:
+                text = token.encode()
+                record.append(struct.pack("<BI", TEXT, len(text)) + text)
+        
+        self.fp.write(b"".join(record))
+    
+    def close(self, emotes=()):
+        emotes = [self.string(filename) for filename in emotes]
+        
+        strings_position = self.fp.tell()
+        self.fp.write(struct.pack("<I", len(self.strings)))
+        for value in self.strings:
+            value = value.encode()
+            self.fp.write(struct.pack("<H", len(value)) + value)
+        
+        emotes_position = self.fp.tell()
+        self.fp.write(struct.pack(f"<I{len(emotes)}I", len(emotes), *emotes))
+        
+        index_position = self.fp.tell()
+        self.fp.write(b"".join(self.index))
+        
+        self.fp.seek(0)
+        self.fp.write(HEADER.pack(MAGIC, len(self.index), strings_position, emotes_position, index_position))
+        self.fp.close()
+        
+        os.replace(f"{self.filename}.tmp", self.filename)
+
+def write(filename, messages, emotes):
+    """
+    Writes the messages, which must be sorted by offset, to `filename`.
+    `emotes` is the emote table, it's read after every message is written
+    so it can still be filled in while `messages` is being generated.
+    """
+    
+    writer = Writer(filename)
+    for message in messages:
+        writer.append(message)
+    writer.close(emotes)
+
+def convert(txt_filename, filename, tokenize, emotes):
+    """
+    One-time conversion of an old chat.txt (one JSON message per line).
+    `tokenize` converts a message from chat.txt into the stored format.
+    """
+    
+    with open(txt_filename) as fp:
+        write(filename, (tokenize(json.loads(line)) for line in fp if line.strip()), emotes)
+    
+    os.remove(txt_filename)
+
+class Offsets():
+    """Sorted sequence of message offsets read straight from the index, for use with bisect."""
+    
+    def __init__(self, store):
+        self.store = store
+    
+    def __len__(self):
+        return len(self.store)
+    
+    def __getitem__(self, i):
+        return self.store.offset(i)
+
+class ChatStore():
+    """
+    Read-only view of a chat file.
+    Behaves like a list of message dicts, but each message is decoded
+    from the memory-mapped file when it's accessed.
+    
+    A message is {"name", "offset", "color", "badges", "tokens"} and
+    self.emotes is the emote file of each emote token.
+    """
+    
+    def __init__(self, filename):
+        with open(filename, "rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        magic, self.count, strings_position, emotes_position, self.index_position = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a chat file")
+        
+        self.strings = []
+        count, = struct.unpack_from("<I", self.mm, strings_position)
+        position = strings_position + 4
+        for _ in range(count):
+            length, = struct.unpack_from("<H", self.mm, position)
+            position += 2
+            self.strings.append(self.mm[position:position + length].decode())
+            position += length
+        
+        count, = struct.unpack_from("<I", self.mm, emotes_position)
+        self.emotes = [
+            self.strings[i]
+            for i in struct.unpack_from(f"<{count}I", self.mm, emotes_position + 4)
+        ]
+    
+        self.offsets = Offsets(self)
+    
+    def __len__(self):
+        return self.count
+    
+    def offset(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        
+        return INDEX.unpack_from(self.mm, self.index_position + i * INDEX.size)[0]
+    
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        
+        mm, strings = self.mm, self.strings
+        offset, position = INDEX.unpack_from(mm, self.index_position + i * INDEX.size)
+        
+        name, color, badge_count = struct.unpack_from("<IIH", mm, position)
+        position += 10
+        
+        badges = []
+        for _ in range(badge_count):
+            _id, version = struct.unpack_from("<II", mm, position)
+            badges.append({"_id": strings[_id], "version": strings[version]})
+            position += 8
+        
+        token_count, = struct.unpack_from("<H", mm, position)
+        position += 2
+        
+        tokens = []
+        for _ in range(token_count):
+            kind, value = struct.unpack_from("<BI", mm, position)
+            position += 5
+            
+            if kind == EMOTE:
+                tokens.append(value)
+            else:
+                tokens.append(mm[position:position + value].decode())
+                position += value
+        
+        return {
+            "name": strings[name],
+            "offset": offset,
+            "color": None if color == NONE else strings[color],
+            "badges": badges,
+            "tokens": tokens
+        }
+    
+    def close(self):
+        self.mm.close()
+
+# Asset pack (assets.pack), every emote and badge image in a single file.
+#
+#   magic
+#   records  key length, data length, key, data
+#
+# Records are only ever appended, when a key is added again the newest record wins.
+# The index of every record is read from the record headers when the pack is opened.
+
+PACK_MAGIC = b"TPPACK\x00\x01"
+RECORD = struct.Struct("<HI")
+
+class AssetPack():
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.index = {}
+        self.mm = None
+        
+        if not os.path.exists(filename):
+            with open(filename, "wb") as fp:
+                fp.write(PACK_MAGIC)
+        
+        self.fp = open(filename, "r+b")
+        self.remap()
+        
+        if self.mm[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise ValueError(f"{filename} is not an asset pack")
+        
+        position = len(PACK_MAGIC)
+        size = len(self.mm)
+        while position + RECORD.size <= size:
+            key_length, data_length = RECORD.unpack_from(self.mm, position)
+            start = position + RECORD.size + key_length
+            
+            if start + data_length > size:
+                # Record cut off by a crash while it was being appended
+                break
+            
+            key = self.mm[position + RECORD.size:start].decode()
+            self.index[key] = start, data_length
+            position = start + data_length
+        
+        self.end = position
+    
+    def remap(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def __contains__(self, key):
+        return key in self.index
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def read(self, key):
+        """Returns the data saved under `key`, raises FileNotFoundError if there isn't any."""
+        
+        with self.lock:
+            if key not in self.index:
+                raise FileNotFoundError(key)
+            
+            start, length = self.index[key]
+            if start + length > len(self.mm):
+                self.remap()
+            
+            return self.mm[start:start + length]
+    
+    def open(self, key):
+        return BytesIO(self.read(key))
+    
+    def add(self, key, data):
+        key = key.encode()
+        
+        with self.lock:
+            self.fp.seek(self.end)
+            self.fp.write(RECORD.pack(len(key), len(data)) + key)
+            self.fp.write(data)
+            self.fp.flush()
+            
+            start = self.end + RECORD.size + len(key)
+            self.index[key.decode()] = start, len(data)
+            self.end = start + len(data)
+    
+    def migrate(self, folders):
+        """Moves the images in `folders` into the pack, leaving the emote lists (.txt)."""
+        
+        for folder in folders:
+            for name in os.listdir(folder):
+                path = f"{folder}/{name}"
+                
+                if name.endswith(".txt") or name.endswith(".tmp") or not os.path.isfile(path):
+                    continue
+                
+                if path not in self:
+                    with open(path, "rb") as fp:
+                        self.add(path, fp.read())
+                os.remove(path)
+
+# Library index (library.db), the summary of every video shown in the video list,
+# so starting up doesn't read the data.txt of every video.
+#
+# The full data of a video, with its list of segments, stays in Files/<id>/data.txt
+# and is only read when it's needed.
+
+LIBRARY_COLUMNS = ("id", "user_id", "user_name", "title", "downloaded", "parts", "played", "total_duration")
+
+class Library():
+    def __init__(self, filename):
+        self.lock = Lock()
+        
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS videos (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                user_name TEXT,
+                title TEXT,
+                downloaded INTEGER,
+                parts INTEGER,
+                played REAL,
+                total_duration REAL
+            )
+        """)
+    
+    def videos(self):
+        """Returns the summary of every video as a dict of LIBRARY_COLUMNS, sorted by id."""
+        
+        with self.lock:
+            return [dict(row) for row in self.db.execute("SELECT * FROM videos ORDER BY id")]
+    
+    def save(self, *summaries):
+        with self.lock, self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO videos VALUES ({', '.join('?' * len(LIBRARY_COLUMNS))})",
+                [[summary[column] for column in LIBRARY_COLUMNS] for summary in summaries]
+            )
+    
+    def remove(self, video_id):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM videos WHERE id = ?", (video_id,))
+    
+    def migrate(self, folder):
+        """One-time import of the data.txt of every video in `folder`, from before the index existed."""
+        
+        with self.lock:
+            version, = self.db.execute("PRAGMA user_version").fetchone()
+        
+        if version:
+            return
+        
+        summaries = []
+        for name in os.listdir(folder):
+            try:
+                with open(f"{folder}/{name}/data.txt") as fp:
+                    data = json.load(fp)
+            except (FileNotFoundError, NotADirectoryError, ValueError):
+                continue
+            
+            summaries.append({**data, "parts": len(data["vod_parts"])})
+        
+        self.save(*summaries)
+        
+        with self.lock, self.db:
+            self.db.execute("PRAGMA user_version = 1")